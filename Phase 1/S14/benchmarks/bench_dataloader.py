@@ -0,0 +1,205 @@
+# benchmarks/bench_dataloader.py
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from queue import Empty
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Dataset name the DataLoader maps to each kind of data, and the per-sample
+# reader it falls back to for that kind
+DATASETS = {'image': 'MNIST', 'csv': 'bench.csv', 'text': 'corpus'}
+SAMPLE_READERS = {'image': '_read_image_data', 'csv': '_read_csv_data', 'text': '_read_unstructured_data'}
+
+def synthesize(kind, num_samples, root, image_size=32, num_features=16, num_labels=10, seed=0):
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(root, 'datasets', DATASETS[kind])
+    if kind == 'image':
+        for i in range(num_samples):
+            label_dir = os.path.join(data_path, str(i % num_labels))
+            os.makedirs(label_dir, exist_ok=True)
+            pixels = rng.integers(0, 256, size=(image_size, image_size, 3), dtype=np.uint8)
+            Image.fromarray(pixels, 'RGB').save(os.path.join(label_dir, f'{i}.png'))
+    elif kind == 'csv':
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        features = rng.random((num_samples, num_features), dtype=np.float32)
+        labels = np.arange(num_samples) % num_labels
+        np.savetxt(data_path, np.column_stack([features, labels]), delimiter=',',
+                   fmt=['%.6f'] * num_features + ['%d'])
+    else:
+        words = np.array(['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit'])
+        for i in range(num_samples):
+            label_dir = os.path.join(data_path, f'label{i % num_labels}')
+            os.makedirs(label_dir, exist_ok=True)
+            with open(os.path.join(label_dir, f'{i}.txt'), 'w') as f:
+                f.write(' '.join(rng.choice(words, size=rng.integers(20, 200))))
+
+def measure(config, root, queue):
+    # Runs in a fresh process so peak RSS belongs to this configuration alone.
+    # Configurations stream by default, so batch latencies include reading and
+    # decoding; with streaming=False in --options, loading happens up front and
+    # samples_per_s (load plus first epoch) is the figure that covers it
+    os.chdir(root)
+    from dataloader.dataloader import DataLoader
+
+    kwargs = {'num_workers': config['num_workers'], 'streaming': True}
+    kwargs.update(config.get('options', {}))
+    start = time.perf_counter_ns()
+    data_loader = DataLoader(dataset_name=DATASETS[config['kind']], batch_size=config['batch_size'],
+                             shuffle=False, **kwargs)
+    load_ns = time.perf_counter_ns() - start
+
+    latencies = []
+    num_samples = 0
+    epoch_start = time.perf_counter_ns()
+    iterator = iter(data_loader)
+    while True:
+        batch_start = time.perf_counter_ns()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        latencies.append(time.perf_counter_ns() - batch_start)
+        num_samples += len(batch)
+    epoch_ns = time.perf_counter_ns() - epoch_start
+    data_loader.close()
+
+    latencies = np.array(latencies, dtype=np.float64) / 1e6
+    queue.put(dict(config, **{
+        'read_path': read_path(data_loader, config['kind']),
+        'samples': num_samples,
+        'load_s': load_ns / 1e9,
+        'time_to_first_batch_s': (load_ns + (latencies[0] * 1e6 if len(latencies) else 0)) / 1e9,
+        'samples_per_s': num_samples / ((load_ns + epoch_ns) / 1e9) if load_ns + epoch_ns else 0.0,
+        'iteration_samples_per_s': num_samples / (epoch_ns / 1e9) if epoch_ns else 0.0,
+        'batch_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+        'batch_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        'batch_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        # Main process, and the largest worker process (workers are joined on close)
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }))
+
+def read_path(data_loader, kind):
+    # The DataLoader method that reads the files for this configuration, following
+    # the choices load_data and stream_batches make
+    options = data_loader.kwargs
+    if not data_loader.streaming:
+        if options.get('backend') == 'memmap' or options.get('cache'):
+            return '_load_records'
+        if data_loader.tokenizes:
+            return '_load_encoded'
+    if data_loader.reads_csv_arrays():
+        return '_stream_csv_batches' if data_loader.streaming else '_read_csv_arrays'
+    if data_loader.tracks_files():
+        return '_read_files'
+    return 'read_tasks' if data_loader.num_workers else SAMPLE_READERS[kind]
+
+def peak_rss_mb(who):
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    return resource.getrusage(who).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 ** 2)
+
+def run_config(config, root, timeout=3600):
+    # The result of the configuration, or None when its process fails or runs out of time
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(config, root, queue))
+    process.start()
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                print(f"Configuration {config} failed (exit code {process.exitcode})", file=sys.stderr)
+                break
+            if time.monotonic() > deadline:
+                print(f"Configuration {config} timed out after {timeout}s", file=sys.stderr)
+                process.terminate()
+                break
+    process.join()
+    return result
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        revision = ''
+    return {'revision': revision, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'timestamp': time.time()}
+
+def config_key(result):
+    return (result['kind'], result['num_samples'], result['batch_size'], result['num_workers'],
+            json.dumps(result.get('options', {}), sort_keys=True))
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {config_key(r): r for r in json.load(f)['results']}
+    regressions = 0
+    print(f"\n{'config':<40} {'samples/s':>22} {'p95 ms':>20}")
+    for result in results:
+        before = baseline.get(config_key(result))
+        if before is None:
+            continue
+        speed = result['samples_per_s'] / before['samples_per_s'] if before['samples_per_s'] else float('inf')
+        latency = result['batch_p95_ms'] / before['batch_p95_ms'] if before['batch_p95_ms'] else 1.0
+        flag = ''
+        if speed < 1 - threshold or latency > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        name = f"{result['kind']} n={result['num_samples']} bs={result['batch_size']} w={result['num_workers']}"
+        print(f"{name:<40} {before['samples_per_s']:>9.0f} -> {result['samples_per_s']:>9.0f} "
+              f"{before['batch_p95_ms']:>8.2f} -> {result['batch_p95_ms']:>8.2f}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="DataLoader throughput/latency benchmark")
+    parser.add_argument("--kinds", default="image,csv,text", help="Read paths to benchmark (default: image,csv,text)")
+    parser.add_argument("--num_samples", type=int, nargs='+', default=[2000], help="Dataset sizes (default: 2000)")
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[32, 256], help="Batch sizes (default: 32 256)")
+    parser.add_argument("--workers", type=int, nargs='+', default=[0, 2], help="Worker counts (default: 0 2)")
+    parser.add_argument("--image_size", type=int, default=32, help="Side of synthetic images (default: 32)")
+    parser.add_argument("--options", default='{}', help="Extra DataLoader kwargs as JSON")
+    parser.add_argument("--output", default="bench_results.json", help="Where to save results")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change flagged as regression")
+    args = parser.parse_args()
+
+    results = []
+    for kind, num_samples in itertools.product(args.kinds.split(','), args.num_samples):
+        with tempfile.TemporaryDirectory() as root:
+            synthesize(kind, num_samples, root, image_size=args.image_size)
+            for batch_size, num_workers in itertools.product(args.batch_sizes, args.workers):
+                config = {'kind': kind, 'num_samples': num_samples, 'batch_size': batch_size,
+                          'num_workers': num_workers, 'options': json.loads(args.options)}
+                result = run_config(config, root)
+                if result is None:
+                    continue
+                results.append(result)
+                print(f"{kind:<6} n={num_samples:<8} bs={batch_size:<5} workers={num_workers:<3} "
+                      f"{result['samples_per_s']:>10.0f} samples/s  first batch {result['time_to_first_batch_s']:.3f}s  "
+                      f"p50/p95/p99 {result['batch_p50_ms']:.2f}/{result['batch_p95_ms']:.2f}/"
+                      f"{result['batch_p99_ms']:.2f} ms  peak {result['peak_rss_mb']:.0f} MB "
+                      f"(largest worker {result['peak_worker_rss_mb']:.0f} MB)")
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print(f"Saved results to {args.output}")
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
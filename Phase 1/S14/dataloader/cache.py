@@ -0,0 +1,30 @@
+# dataloader/cache.py
+
+import hashlib
+import os
+from .utils import function_fingerprint
+
+def dataset_fingerprint(data_path: str) -> str:
+    # Paths, sizes and mtimes of everything under data_path; contents are not read
+    digest = hashlib.sha1()
+    paths = [data_path] if os.path.isfile(data_path) else sorted(
+        os.path.join(root, file) for root, _, files in os.walk(data_path) for file in files)
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f'{os.path.relpath(path, data_path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+def dataset_key(data_path: str, preprocess_func, options=None) -> str:
+    digest = hashlib.sha1()
+    digest.update(os.path.abspath(data_path).encode())
+    digest.update(dataset_fingerprint(data_path).encode())
+    digest.update(function_fingerprint(preprocess_func).encode())
+    digest.update(repr(sorted((options or {}).items())).encode())
+    return f'{os.path.basename(data_path)}-{digest.hexdigest()[:16]}'
+
+class DatasetCache:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.records')
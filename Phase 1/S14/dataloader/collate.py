@@ -0,0 +1,87 @@
+# dataloader/collate.py
+
+from collections import namedtuple
+from numbers import Number
+import numpy as np
+from .dataset import ArrayData, DataSample
+from .tokenizer import pad_batch, pad_flat
+
+class _SizedBatch:
+    __slots__ = ()
+
+    # A batch reports the number of samples it holds, like the list it replaces;
+    # _make and _replace are redone since namedtuple's versions check len()
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def _make(cls, iterable):
+        return cls(*iterable)
+
+    def _replace(self, **kwargs):
+        return type(self)(**dict(self._asdict(), **kwargs))
+
+class Batch(_SizedBatch, namedtuple('Batch', ['features', 'labels'])):
+    __slots__ = ()
+
+    def samples(self):
+        for features, label in zip(self.features, self.labels):
+            yield DataSample(features=features, label=label)
+
+# Token id sequences padded to a common length: features is (N, L) int32
+class PaddedBatch(_SizedBatch, namedtuple('PaddedBatch', ['features', 'lengths', 'labels'])):
+    __slots__ = ()
+
+def is_numeric_sample(sample) -> bool:
+    features = sample.features
+    if isinstance(features, np.ndarray):
+        numeric = np.issubdtype(features.dtype, np.number)
+    elif isinstance(features, (list, tuple)):
+        numeric = all(isinstance(x, Number) for x in features)
+    else:
+        numeric = False
+    return numeric and isinstance(sample.label, Number)
+
+class Collator:
+    # pad_id set: samples are variable-length token id arrays, padded into a PaddedBatch
+    def __init__(self, reuse_buffers=False, dtype=None, pad_id=None):
+        self.reuse_buffers = reuse_buffers
+        self.dtype = dtype
+        self.pad_id = pad_id
+        self._buffers = {}
+
+    def __call__(self, samples):
+        if isinstance(samples, ArrayData):
+            if samples.offsets is None and self.pad_id is None:
+                return Batch(features=samples.features, labels=samples.labels)
+            samples = samples.ragged()
+            ids, lengths = pad_flat(samples.features, samples.offsets, self.pad_id or 0)
+            return PaddedBatch(features=ids, lengths=lengths, labels=samples.labels)
+        if self.pad_id is not None and samples:
+            ids, lengths = pad_batch([sample.features for sample in samples], self.pad_id)
+            return PaddedBatch(features=ids, lengths=lengths, labels=np.asarray([sample.label for sample in samples]))
+        if not samples or not is_numeric_sample(samples[0]):
+            return samples
+        first = samples[0].features
+        shape = np.shape(first)
+        if any(np.shape(sample.features) != shape for sample in samples):
+            # Samples of different shapes stay a list, as in pack_samples
+            return samples
+        dtype = self.dtype or (first.dtype if isinstance(first, np.ndarray) else np.float32)
+        features = self._buffer('features', (len(samples),) + shape, dtype)
+        labels = self._buffer('labels', (len(samples),), np.int64)
+        for i, sample in enumerate(samples):
+            features[i] = sample.features
+            labels[i] = sample.label
+        return Batch(features=features, labels=labels)
+
+    def _buffer(self, name, shape, dtype):
+        if not self.reuse_buffers:
+            return np.empty(shape, dtype=dtype)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.shape[1:] != shape[1:] or len(buffer) < shape[0]:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        # The last, shorter batch of an epoch reuses the front of the buffer
+        return buffer[:shape[0]]
+
+default_collate = Collator()
@@ -2,17 +2,33 @@
 
 import os
 import sys
-import requests
-from collections import namedtuple
+import time
 from contextlib import contextmanager
-from .preprocessors import default_preprocess
-from .utils import download_file, timer, cached_property
-import csv
-from PIL import Image
+from functools import partial
+from itertools import count, islice
+from .preprocessors import default_preprocess, Pipeline
+from .cache import DatasetCache, dataset_fingerprint, dataset_key
+from .collate import Batch, Collator, PaddedBatch
+from .dataset import DataSample, ArrayData, pack_samples
+from .plan import Plan, join_chunks
+from .file_index import FileIndex
+from .download import DownloadManager, DownloadSpec, extract
+from .instrumentation import Metrics, NULL_METRICS
+from .utils import cache_result, timer, cached_property, batched, shuffle_buffer
+from .tokenizer import Vocabulary, build_and_encode, encode_corpus, load_encoded, save_encoded
+from .shards import ShardedCorpus, is_packed
+from .samplers import BatchSampler, BucketBatchSampler, RandomSampler, SequentialSampler, epoch_rng, lengths_of
+from .stats import RunningStats
+from .storage import open_records, sample_chunks, write_records
+from .workers import Prefetcher, make_pool, parallel_map, process_shard, read_shard
+from .images import decode_image
 import numpy as np
-from typing import List, Callable, Any, Generator
+from typing import List, Callable, Any, Generator, Union
 
-DataSample = namedtuple('DataSample', ['features', 'label'])
+def file_key(path: str, *args, **kwargs):
+    # Cache key for a file reader: the file changes, the key changes
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns) + args + tuple(sorted(kwargs.items()))
 
 class DataLoader:
     def __init__(self, dataset_name='MNIST', batch_size=32, shuffle=True, **kwargs):
@@ -20,30 +36,356 @@ class DataLoader:
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.kwargs = kwargs
-        self.data: List[DataSample] = []
+        self.streaming = kwargs.get('streaming', False)
+        self.num_workers = kwargs.get('num_workers', 0)
+        self.sampler = kwargs.get('sampler') or (RandomSampler(kwargs.get('seed')) if shuffle else SequentialSampler())
+        if kwargs.get('max_tokens') and 'sampler' not in kwargs:
+            # Length-bucketed batches of up to max_tokens padded tokens each, instead of batch_size samples
+            self.sampler = BucketBatchSampler(kwargs['max_tokens'], shuffle=shuffle, seed=kwargs.get('seed'))
+        if self.streaming and ('sampler' in kwargs or kwargs.get('max_tokens')):
+            raise ValueError("samplers need random access to the data, which streaming=True does not keep")
+        self.epoch = 0
+        self._version = 0
+        # prefetch=N assembles up to N batches ahead on a background thread
+        self.prefetch = kwargs.get('prefetch', 0)
+        self._prefetcher = None
+        if self.prefetch and kwargs.get('reuse_buffers', False):
+            raise ValueError("reuse_buffers=True would overwrite prefetched batches still waiting to be consumed")
+        # profile=True records per-stage timings in self.metrics
+        self.metrics = Metrics() if kwargs.get('profile', False) else NULL_METRICS
+        self._batch_returned_ns = None
+        # image_size=(width, height) decodes straight to that size, image_mode converts
+        self.image_options = {name: kwargs[key] for name, key in (('size', 'image_size'), ('mode', 'image_mode'))
+                              if kwargs.get(key) is not None}
+        self.image_reader = DataLoader._read_image_file
+        if kwargs.get('decode_cache') is not None:
+            # e.g. decode_cache={'max_bytes': 2 ** 30, 'disk_dir': 'datasets/.decoded'}
+            self.image_reader = cache_result(DataLoader._read_image_file, key=file_key, **kwargs['decode_cache'])
+        # ArrayData when the samples pack into arrays, else a list of DataSamples
+        self.data: Union[ArrayData, List[DataSample]] = []
+        self.feature_names = None
+        self.label_names = None
         self.index = 0
+        self._order = None
+        # Where each batch of _order ends, when a BatchSampler decides the batches
+        self._batch_ends = None
+        self._stream = None
+        # Pending apply_transformation / filter_data steps, see materialize(), and
+        # those already applied to self.data
+        self._plan = Plan()
+        self._applied = Plan()
+        # What refresh() compares against: for datasets of one sample per file the
+        # (size, mtime) of each file and the file of each row, else a fingerprint
+        self._files = None
+        self._row_paths = None
+        self._source_fingerprint = None
+        self._statistics_state = None
+        # tokenizer=True (or {'min_freq': ..., 'max_size': ...}) encodes text to int32 ids
+        # with a vocabulary built from the dataset, unless one is given as vocabulary=
+        self.vocabulary = kwargs.get('vocabulary')
+        self.tokenizes = bool(kwargs.get('tokenizer') or self.vocabulary is not None)
+        self.collate_fn = kwargs.get('collate_fn', Collator(reuse_buffers=kwargs.get('reuse_buffers', False),
+                                                            pad_id=0 if self.tokenizes else None))
+        transforms = kwargs.get('transforms')
+        if transforms is not None and not isinstance(transforms, Pipeline):
+            transforms = Pipeline(*transforms, reuse_buffers=kwargs.get('reuse_buffers', False))
+        self.transforms = transforms
+        # augment_func=f (or a list) is the random stage: it runs on every batch as it
+        # is served, after the deterministic preprocess_func and transforms, with an
+        # rng seeded from (seed, epoch, batch), so each epoch sees fresh augmentations
+        augmentations = kwargs.get('augment_func')
+        if augmentations is not None and not isinstance(augmentations, Pipeline):
+            augmentations = Pipeline(*(augmentations if isinstance(augmentations, (list, tuple)) else [augmentations]))
+        self.augmentations = augmentations
+        self._augment_seed = kwargs.get('seed')
+        if self._augment_seed is None:
+            self._augment_seed = np.random.SeedSequence().entropy
+        self._batch_counter = count()
+        self._iteration_epoch = 0
         self.load_data()
     
     @timer
     def load_data(self):
-        if not os.path.exists(f'datasets/{self.dataset_name}'):
+        self._data_changed()
+        data_path = f'datasets/{self.dataset_name}'
+        if not os.path.exists(data_path):
             self.download_dataset()
-        self.data = list(self.preprocess_data(self.read_data()))
+        self._applied = Plan()
+        self._files = self._row_paths = self._source_fingerprint = None
+        if self.tokenizes and self.vocabulary is None and not self.encodes_in_memory():
+            self.vocabulary = self._load_vocabulary(self._token_cache_path())
+        if self.streaming:
+            # Samples are pulled from the read_data generator chain in __iter__
+            return
+        if not self.tracks_files():
+            self._source_fingerprint = dataset_fingerprint(data_path)
+        if self.kwargs.get('backend') == 'memmap':
+            self.data = self._load_records(self.kwargs.get('memmap_path', f'datasets/{self.dataset_name}.records'))
+        elif self.kwargs.get('cache', False):
+            self.data = self._load_records()
+        elif self.tokenizes:
+            self.data = self._load_encoded()
+        elif self.reads_csv_arrays():
+            self.data = ArrayData.concatenate(self._read_csv_arrays(data_path))
+        elif self.tracks_files():
+            files = list(self._list_file_stats(data_path))
+            self._files = {path: (size, mtime) for path, _, size, mtime in files}
+            self.data, self._row_paths = self._load_files(self._reader_entries(files))
+        else:
+            self.data = pack_samples(self.load_samples())
+
+    def tracks_files(self) -> bool:
+        # Datasets of one sample per file under datasets/<name>/<label>/, loaded into
+        # memory with each row's file on record, which lets refresh() go file by file
+        data_path = f'datasets/{self.dataset_name}'
+        return (os.path.isdir(data_path) and not is_packed(data_path) and not self.streaming
+                and not self.tokenizes and self.kwargs.get('backend') != 'memmap' and not self.kwargs.get('cache'))
+
+    def _list_file_stats(self, data_path: str, restat: bool = False) -> Generator[tuple, None, None]:
+        # (path, label, size, mtime_ns) for every file under data_path; restat
+        # makes a file index stat each file, to see files rewritten in place
+        if self.kwargs.get('file_index', False):
+            yield from FileIndex.load_or_build(data_path, threads=self.kwargs.get('scan_threads', 8),
+                                               restat=restat).entries()
+            return
+        for root, _, files in os.walk(data_path):
+            for file in files:
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                yield path, os.path.basename(root), stat.st_size, stat.st_mtime_ns
+
+    def _reader_entries(self, files) -> List[tuple]:
+        # The (path, label) arguments of the reader for the listed files it reads
+        if self.dataset_name in ['MNIST', 'CIFAR-10', 'CIFAR-100']:
+            return [(path, int(label)) for path, label, *_ in files if path.endswith(('.png', '.jpg', '.jpeg'))]
+        return [(path, label) for path, label, *_ in files]
+
+    def _load_files(self, entries: List[tuple]):
+        # (data, path of each row) from reading and preprocessing the given files
+        paths = []
+
+        def samples():
+            for path, sample in self._read_files(entries):
+                paths.append(path)
+                yield sample
+        data = pack_samples(samples())
+        return data, np.array(paths, dtype=str)
+
+    def _read_files(self, entries: List[tuple]) -> Generator[tuple, None, None]:
+        # (path, sample) for each entry that could be read, in entry order
+        with self.read_tasks() as (reader, _):
+            yield from self._read_entries(reader, entries)
+
+    def _read_entries(self, reader, entries: List[tuple]) -> Generator[tuple, None, None]:
+        preprocess_func = self.kwargs.get('preprocess_func', default_preprocess)
+        if not self.num_workers:
+            preprocess = self.metrics.timed('preprocess')(preprocess_func)
+            # Image readers decode, as in _read_image_data
+            stage = 'decode' if self.dataset_name in ['MNIST', 'CIFAR-10', 'CIFAR-100'] else 'read'
+            for entry in entries:
+                with self.metrics.span(stage):
+                    sample = reader(*entry)
+                if sample is not None:
+                    yield entry[0], preprocess(sample)
+            return
+        max_in_flight = self.num_workers + self.kwargs.get('prefetch_batches', 2)
+        shards = list(batched(entries, self.batch_size))
+        with make_pool(self.num_workers, reader, preprocess_func) as pool:
+            results = parallel_map(pool, read_shard, shards, max_in_flight=max_in_flight)
+            for shard, samples in zip(shards, self.metrics.timed_iter(results, 'wait_for_workers')):
+                for (path, *_), sample in zip(shard, samples):
+                    if sample is not None:
+                        yield path, sample
+
+    def refresh(self) -> dict:
+        # Brings the data up to date with datasets/<name>. Files added or changed
+        # since they were loaded are read, preprocessed and put through the
+        # transformations and filters already applied; rows of changed and deleted
+        # files are dropped. Datasets read as a whole are reloaded if they changed.
+        # Returns the added, changed and removed paths
+        data_path = f'datasets/{self.dataset_name}'
+        if self.streaming:
+            # Every epoch reads the files afresh
+            return {'added': [], 'changed': [], 'removed': []}
+        if self._files is None:
+            if dataset_fingerprint(data_path) == self._source_fingerprint:
+                return {'added': [], 'changed': [], 'removed': []}
+            self._plan = Plan(self._applied.steps + self._plan.steps)
+            self.load_data()
+            return {'added': [], 'changed': [data_path], 'removed': []}
+
+        files = list(self._list_file_stats(data_path, restat=True))
+        current = {path: (size, mtime) for path, _, size, mtime in files}
+        added = [path for path in current if path not in self._files]
+        changed = [path for path in current if path in self._files and current[path] != self._files[path]]
+        removed = [path for path in self._files if path not in current]
+        if not (added or changed or removed):
+            return {'added': added, 'changed': changed, 'removed': removed}
+
+        statistics = self._statistics_state
+        appends_only = not (changed or removed) and statistics is not None and statistics[0] == self._version
+        stale = np.isin(self._row_paths, changed + removed)
+        if stale.any():
+            self.data = self._select(~stale)
+            self._row_paths = self._row_paths[~stale]
+        new_paths = set(added + changed)
+        new_data, new_row_paths = self._load_files(self._reader_entries(f for f in files if f[0] in new_paths))
+        new_data, new_row_paths = self._applied.execute(new_data, self.kwargs.get('plan_chunk_size', 4096),
+                                                        keys=new_row_paths)
+        self.data = join_chunks([self.data, new_data]) if len(self.data) else new_data
+        self._row_paths = np.concatenate([self._row_paths, new_row_paths])
+        self._files = current
+        self._data_changed()
+        if appends_only:
+            # Fold the new rows into the statistics instead of recomputing them
+            _, stats, num_samples = statistics
+            added_stats, added_samples = self._accumulate_statistics(self._chunks(new_data))
+            self._set_statistics(stats.merge(added_stats), num_samples + added_samples)
+        return {'added': added, 'changed': changed, 'removed': removed}
+
+    def _select(self, mask: np.ndarray):
+        if isinstance(self.data, ArrayData):
+            return self.data[mask]
+        return [sample for sample, keep in zip(self.data, mask) if keep]
+
+    def records_key(self) -> str:
+        options = {name: self.kwargs.get(name) for name in ('delimiter', 'header', 'label_column', 'feature_columns')}
+        return dataset_key(f'datasets/{self.dataset_name}', self.kwargs.get('preprocess_func', default_preprocess), options)
+
+    def _cache_key(self, make_key):
+        # make_key(), or None when a function it covers carries a value that cannot
+        # be fingerprinted; such results are not reused
+        try:
+            return make_key()
+        except TypeError as e:
+            print(f"Not caching {self.dataset_name}: {e}")
+            return None
+
+    def _load_records(self, path: str = None):
+        # Memory-map the record file at path (by default, the dataset cache entry
+        # for records_key()), (re)building it when it is missing or was written for
+        # other files, options or preprocess_func
+        key = self._cache_key(self.records_key)
+        if path is None:
+            if key is None:
+                return pack_samples(self.load_samples())
+            path = DatasetCache(self.kwargs.get('cache_dir', 'datasets/.cache')).path(key)
+        try:
+            records = open_records(path) if key is not None else None
+        except (OSError, ValueError):
+            records = None
+        if records is None or records[1].get('key') != key:
+            data_path = f'datasets/{self.dataset_name}'
+            chunks = self._read_csv_arrays(data_path) if self.reads_csv_arrays() else sample_chunks(self.load_samples())
+            try:
+                write_records(path, chunks, lambda: dict(self._names_metadata(), key=key))
+            except ValueError as e:
+                print(f"Not storing {self.dataset_name} as records: {e}")
+                return pack_samples(self.load_samples())
+            records = open_records(path)
+        data, metadata = records
+        self.feature_names = metadata.get('feature_names')
+        self.label_names = metadata.get('label_names')
+        return data
+
+    def _token_cache_path(self) -> str:
+        # Path prefix of the cached vocabulary and encoded corpus; None when they
+        # cannot be cached
+        options = self.kwargs.get('tokenizer')
+        options = sorted(options.items()) if isinstance(options, dict) else None
+        key = self._cache_key(lambda: dataset_key(f'datasets/{self.dataset_name}',
+                                                  self.kwargs.get('preprocess_func', default_preprocess),
+                                                  {'tokenizer': options}))
+        if key is None:
+            return None
+        return os.path.join(self.kwargs.get('cache_dir', 'datasets/.cache'), key)
+
+    def encodes_in_memory(self) -> bool:
+        # Tokenized data is loaded by _load_encoded, which builds any missing
+        # vocabulary in the same pass
+        return (self.tokenizes and not self.streaming and self.kwargs.get('backend') != 'memmap'
+                and not self.kwargs.get('cache', False))
+
+    def _tokenizer_options(self) -> dict:
+        options = self.kwargs.get('tokenizer')
+        return options if isinstance(options, dict) else {}
+
+    def _load_vocabulary(self, cache_path, build=True) -> Vocabulary:
+        # Built in one streaming pass over the texts, then kept for repeat runs;
+        # None if it is not cached yet and build is False
+        if cache_path is not None and os.path.exists(f'{cache_path}.vocab.json'):
+            return Vocabulary.load(f'{cache_path}.vocab.json')
+        if not build:
+            return None
+        vocabulary = Vocabulary.build((sample.features for sample in self.load_samples()), **self._tokenizer_options())
+        self._save_vocabulary(vocabulary, cache_path)
+        return vocabulary
+
+    @staticmethod
+    def _save_vocabulary(vocabulary: Vocabulary, cache_path):
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            vocabulary.save(f'{cache_path}.vocab.json')
+
+    def _load_encoded(self) -> ArrayData:
+        # The encoded corpus is cached as one flat id array with offsets, so repeat
+        # runs skip tokenization. A vocabulary not built yet comes out of the same
+        # pass over the texts that encodes them
+        cache_path = self._token_cache_path()
+        if self.vocabulary is None:
+            self.vocabulary = self._load_vocabulary(cache_path, build=False)
+        if self.vocabulary is None:
+            self.vocabulary, ids, offsets, labels = build_and_encode(self.load_samples(), **self._tokenizer_options())
+            self._save_vocabulary(self.vocabulary, cache_path)
+            if cache_path is not None:
+                save_encoded(f'{cache_path}-{self.vocabulary.fingerprint()}.tokens.npz', ids, offsets, labels)
+            return ArrayData(ids, np.asarray(labels), offsets)
+        path = None if cache_path is None else f'{cache_path}-{self.vocabulary.fingerprint()}.tokens.npz'
+        if path is not None and os.path.exists(path):
+            ids, offsets, labels = load_encoded(path)
+        else:
+            ids, offsets, labels = encode_corpus(self.vocabulary, self.load_samples())
+            if path is not None:
+                save_encoded(path, ids, offsets, labels)
+        return ArrayData(ids, np.asarray(labels), offsets)
+
+    def encode_sample(self, sample: DataSample) -> DataSample:
+        return sample._replace(features=self.vocabulary.encode(sample.features))
+
+    def _names_metadata(self):
+        # Called by write_records once the chunks are consumed and the readers have set the names
+        return {'feature_names': self.feature_names, 'label_names': self.label_names}
     
     @timer
     def download_dataset(self):
         print(f"Downloading {self.dataset_name} dataset...")
-        url = self.get_dataset_url()
-        download_file(url, f'datasets/{self.dataset_name}')
+        # Files collect in a staging directory that keeps partial downloads for
+        # resuming, and only becomes datasets/<name> once everything is in place
+        specs = self.get_dataset_files()
+        if not specs:
+            raise ValueError(f"Dataset {self.dataset_name} is not in datasets/ and has no download")
+        staging_path = f'datasets/{self.dataset_name}.partial'
+        manager = DownloadManager(staging_path, max_connections=self.kwargs.get('download_connections', 8))
+        for path in manager.download(specs):
+            extract(path, staging_path)
+        os.replace(staging_path, f'datasets/{self.dataset_name}')
     
-    def get_dataset_url(self):
-        # Define URLs for different datasets
-        urls = {
-            'MNIST': 'http://yann.lecun.com/exdb/mnist/',
-            'CIFAR-10': 'https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz',
-            'CIFAR-100': 'https://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz',
+    def get_dataset_files(self) -> List[DownloadSpec]:
+        # Define files (with their published checksums) for different datasets
+        mnist = 'http://yann.lecun.com/exdb/mnist/'
+        files = {
+            'MNIST': [
+                DownloadSpec(mnist + 'train-images-idx3-ubyte.gz', checksum='md5:f68b3c2dcbeaaa9fbdd348bbdeb94873'),
+                DownloadSpec(mnist + 'train-labels-idx1-ubyte.gz', checksum='md5:d53e105ee54ea40749a09fcbcd1e9432'),
+                DownloadSpec(mnist + 't10k-images-idx3-ubyte.gz', checksum='md5:9fb629c4189551a2d022fa330f9573f3'),
+                DownloadSpec(mnist + 't10k-labels-idx1-ubyte.gz', checksum='md5:ec29112dd5afa0611ce80d1b7f02629c'),
+            ],
+            'CIFAR-10': [DownloadSpec('https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz',
+                                      checksum='md5:c58f30108f718f92721af3b95e74349a')],
+            'CIFAR-100': [DownloadSpec('https://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz',
+                                       checksum='md5:eb9058c3a382ffc7106e4002c42a8d85')],
         }
-        return urls.get(self.dataset_name, '')
+        return files.get(self.dataset_name, [])
     
     def read_data(self) -> Generator[DataSample, None, None]:
         data_path = f'datasets/{self.dataset_name}'
@@ -56,83 +398,447 @@ class DataLoader:
             yield from self._read_unstructured_data(data_path)
     
     def _read_image_data(self, data_path: str) -> Generator[DataSample, None, None]:
+        for img_path, label in self.metrics.timed_iter(self._list_image_files(data_path), 'read'):
+            with self.metrics.span('decode'):
+                sample = self.image_reader(img_path, label, **self.image_options)
+            if sample is not None:
+                yield sample
+
+    def _list_image_files(self, data_path: str) -> Generator[tuple, None, None]:
+        for file_path, label in self._list_files(data_path):
+            if file_path.endswith(('.png', '.jpg', '.jpeg')):
+                yield file_path, int(label)
+
+    def _list_files(self, data_path: str) -> Generator[tuple, None, None]:
+        # (path, label) for every file under data_path, labelled by its directory;
+        # file_index=True lists from a manifest kept at datasets/<name>.index.npz
+        if self.kwargs.get('file_index', False):
+            index = FileIndex.load_or_build(data_path, threads=self.kwargs.get('scan_threads', 8))
+            for file_path, label, _, _ in index.entries():
+                yield file_path, label
+            return
         for root, _, files in os.walk(data_path):
             for file in files:
-                if file.endswith(('.png', '.jpg', '.jpeg')):
-                    img_path = os.path.join(root, file)
-                    try:
-                        with Image.open(img_path) as img:
-                            label = int(os.path.basename(root))
-                            yield DataSample(features=np.array(img), label=label)
-                    except IOError:
-                        print(f"Error reading image: {img_path}")
+                yield os.path.join(root, file), os.path.basename(root)
+
+    @staticmethod
+    def _read_image_file(img_path: str, label: int, size=None, mode=None):
+        try:
+            return DataSample(features=decode_image(img_path, size=size, mode=mode), label=label)
+        except IOError:
+            print(f"Error reading image: {img_path}")
     
     def _read_csv_data(self, data_path: str) -> Generator[DataSample, None, None]:
+        for features, labels in self._read_csv_arrays(data_path):
+            for row, label in zip(features, labels.tolist()):
+                yield DataSample(features=row, label=label)
+
+    def _read_csv_arrays(self, data_path: str) -> Generator[tuple, None, None]:
+        # Parse the file in chunks of csv_chunk_rows lines straight into a float32
+        # feature matrix and an int64 label vector. A row that does not parse
+        # raises ValueError rather than cutting the data short
+        delimiter = self.kwargs.get('delimiter', ',')
+        chunk_rows = self.kwargs.get('csv_chunk_rows', 65536)
         try:
             with open(data_path, 'r') as csvfile:
-                reader = csv.reader(csvfile)
-                for row in reader:
-                    features = [float(x) for x in row[:-1]]
-                    label = int(row[-1])
-                    yield DataSample(features=features, label=label)
-        except (IOError, ValueError) as e:
+                names = next(csvfile).rstrip('\r\n').split(delimiter) if self.kwargs.get('header', False) else None
+                with self.metrics.span('read'):
+                    lines = list(islice(csvfile, chunk_rows))
+                if not lines:
+                    return
+                num_columns = len(names) if names else len(lines[0].split(delimiter))
+                label_column, feature_columns = self._csv_columns(num_columns, names, lines, delimiter)
+                if names:
+                    self.feature_names = [names[i] for i in feature_columns]
+                label_codes = None
+                first_row = 2 if names else 1
+                while lines:
+                    with self.metrics.span('decode', items=len(lines)):
+                        try:
+                            features = np.loadtxt(lines, delimiter=delimiter, usecols=feature_columns,
+                                                  dtype=np.float32, comments=None, ndmin=2)
+                            raw_labels = np.loadtxt(lines, delimiter=delimiter, usecols=label_column,
+                                                    dtype=str, comments=None, ndmin=1)
+                            labels, label_codes = self._encode_labels(raw_labels, label_codes)
+                        except ValueError as e:
+                            raise ValueError(f"{data_path}, in the rows from line {first_row}: {e}") from e
+                    yield features, labels
+                    first_row += len(lines)
+                    with self.metrics.span('read'):
+                        lines = list(islice(csvfile, chunk_rows))
+        except (IOError, StopIteration) as e:
             print(f"Error reading CSV file: {e}")
+
+    def _csv_columns(self, num_columns: int, names, lines: List[str], delimiter: str):
+        # Without feature_columns, every column but the label that is numeric in
+        # the first chunk of lines is a feature; the others (e.g. names) are skipped
+        def resolve(column):
+            return names.index(column) if isinstance(column, str) else column % num_columns
+        label_column = resolve(self.kwargs.get('label_column', -1))
+        feature_columns = self.kwargs.get('feature_columns')
+        if feature_columns is not None:
+            return label_column, [resolve(column) for column in feature_columns]
+        columns = [i for i in range(num_columns) if i != label_column]
+        values = np.loadtxt(lines, delimiter=delimiter, usecols=columns, dtype=str, comments=None, ndmin=2)
+        numeric = []
+        for i, column in enumerate(columns):
+            try:
+                values[:, i].astype(np.float32)
+            except ValueError:
+                continue
+            numeric.append(column)
+        if not numeric:
+            raise ValueError(f"no numeric feature columns in {self.dataset_name}")
+        return label_column, numeric
+
+    def _encode_labels(self, raw_labels: np.ndarray, label_codes) -> tuple:
+        # (labels, label_codes). The first chunk (label_codes None) settles the
+        # encoding for the file: integer labels (label_codes False), after which a
+        # non-integer label is an error, or category codes named in
+        # self.label_names, with one code table (a dict) shared by every chunk
+        if label_codes is None or label_codes is False:
+            try:
+                return raw_labels.astype(np.int64), False
+            except ValueError:
+                if label_codes is False:
+                    raise
+            label_codes = {}
+        values, inverse = np.unique(raw_labels, return_inverse=True)
+        codes = np.array([label_codes.setdefault(value, len(label_codes)) for value in values.tolist()])
+        self.label_names = list(label_codes)
+        return codes[inverse].astype(np.int64), label_codes
+
+    def reads_csv_arrays(self) -> bool:
+        # Bulk array path, unless rows need a per-sample preprocess function
+        preprocess_func = self.kwargs.get('preprocess_func', default_preprocess)
+        return (self.dataset_name.endswith('.csv') and self.kwargs.get('vectorized_csv', True)
+                and preprocess_func is default_preprocess and not self.num_workers)
     
     def _read_unstructured_data(self, data_path: str) -> Generator[DataSample, None, None]:
-        for root, _, files in os.walk(data_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, 'r') as f:
-                        content = f.read()
-                    label = os.path.basename(root)
-                    yield DataSample(features=content, label=label)
-                except IOError:
-                    print(f"Error reading file: {file_path}")
+        if is_packed(data_path):
+            # A corpus packed with dataloader.shards
+            corpus = ShardedCorpus(data_path)
+            try:
+                yield from self.metrics.timed_iter(corpus, 'read')
+            finally:
+                corpus.close()
+            return
+        for file_path, label in self._list_unstructured_files(data_path):
+            with self.metrics.span('read'):
+                sample = self._read_text_file(file_path, label)
+            if sample is not None:
+                yield sample
+
+    def _list_unstructured_files(self, data_path: str) -> Generator[tuple, None, None]:
+        return self._list_files(data_path)
+
+    @staticmethod
+    def _read_text_file(file_path: str, label: str):
+        try:
+            with open(file_path, 'r') as f:
+                content = f.read()
+            return DataSample(features=content, label=label)
+        except IOError:
+            print(f"Error reading file: {file_path}")
+
+    @contextmanager
+    def read_tasks(self):
+        # (reader, entries) for the worker pool: file-backed datasets are sharded by
+        # path so workers do the reading, CSV rows are parsed here and shipped as
+        # samples. A packed corpus is closed on leaving the block
+        data_path = f'datasets/{self.dataset_name}'
+        if self.dataset_name in ['MNIST', 'CIFAR-10', 'CIFAR-100']:
+            yield partial(self.image_reader, **self.image_options), self._list_image_files(data_path)
+        elif self.dataset_name.endswith('.csv'):
+            yield None, self._read_csv_data(data_path)
+        elif is_packed(data_path):
+            corpus = ShardedCorpus(data_path)
+            try:
+                yield corpus.sample, ((i,) for i in range(len(corpus)))
+            finally:
+                corpus.close()
+        else:
+            yield DataLoader._read_text_file, self._list_unstructured_files(data_path)
     
     def preprocess_data(self, data: Generator[DataSample, None, None]) -> Generator[DataSample, None, None]:
         preprocess_func = self.kwargs.get('preprocess_func', default_preprocess)
-        return map(preprocess_func, data)
+        return map(self.metrics.timed('preprocess')(preprocess_func), data)
+
+    def load_samples(self) -> Generator[DataSample, None, None]:
+        if not self.num_workers:
+            yield from self.preprocess_data(self.read_data())
+            return
+        preprocess_func = self.kwargs.get('preprocess_func', default_preprocess)
+        max_in_flight = self.num_workers + self.kwargs.get('prefetch_batches', 2)
+        with self.read_tasks() as (reader, entries), make_pool(self.num_workers, reader, preprocess_func) as pool:
+            shards = batched(entries, self.batch_size)
+            results = parallel_map(pool, process_shard, shards,
+                                   ordered=self.kwargs.get('ordered', True), max_in_flight=max_in_flight)
+            # Worker-side reading and preprocessing shows up as time spent waiting on shards
+            for samples in self.metrics.timed_iter(results, 'wait_for_workers'):
+                yield from samples
     
     def __iter__(self):
+        self.close()
         self.index = 0
-        if self.shuffle:
-            import random
-            random.shuffle(self.data)
+        if self.streaming:
+            self._stream = self.stream_batches(self.epoch)
+        else:
+            # The data itself is never reordered, each epoch walks a fresh index order
+            self.materialize()
+            if isinstance(self.sampler, BatchSampler):
+                batches = self.sampler.batches(self.sample_lengths, self.epoch)
+                self._order = np.concatenate(batches) if batches else np.empty(0, dtype=np.intp)
+                self._batch_ends = np.cumsum([len(batch) for batch in batches])
+            else:
+                self._order = self.sampler.indices(self.data, self.epoch)
+                self._batch_ends = None
+        self._iteration_epoch = self.epoch
+        self._batch_counter = count()
+        self.epoch += 1
+        if self.prefetch:
+            self._prefetcher = Prefetcher(self._load_batches(), self.prefetch)
         return self
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def stream_batches(self, epoch=0) -> Generator[List[DataSample], None, None]:
+        # Shuffled streams draw from epoch_rng(seed, epoch), like the samplers
+        rng = epoch_rng(self.kwargs.get('seed'), epoch)
+        if self.reads_csv_arrays() and not self._plan:
+            yield from self._stream_csv_batches(rng)
+            return
+        samples = self.load_samples()
+        if self._plan:
+            samples = (sample for sample in map(self._plan, samples) if sample is not None)
+        if self.tokenizes:
+            samples = map(self.encode_sample, samples)
+        if self.shuffle:
+            samples = shuffle_buffer(samples, self.kwargs.get('shuffle_buffer_size', 1024), rng)
+        yield from batched(samples, self.batch_size)
+
+    def _stream_csv_batches(self, rng: np.random.Generator) -> Generator[ArrayData, None, None]:
+        # Slice parsed chunks into batches, carrying the remainder into the next
+        # chunk; shuffling is chunk-local so memory stays bounded by csv_chunk_rows
+        pending_features, pending_labels = None, None
+        for features, labels in self._read_csv_arrays(f'datasets/{self.dataset_name}'):
+            if self.shuffle:
+                order = rng.permutation(len(labels))
+                features, labels = features[order], labels[order]
+            if pending_labels is not None:
+                features = np.concatenate([pending_features, features])
+                labels = np.concatenate([pending_labels, labels])
+            full = len(labels) - len(labels) % self.batch_size
+            for start in range(0, full, self.batch_size):
+                yield ArrayData(features[start:start + self.batch_size], labels[start:start + self.batch_size])
+            pending_features, pending_labels = features[full:], labels[full:]
+        if pending_labels is not None and len(pending_labels):
+            yield ArrayData(pending_features, pending_labels)
     
     def __next__(self):
-        if self.index < len(self.data):
-            batch = self.data[self.index:self.index + self.batch_size]
-            self.index += self.batch_size
-            return batch
+        if not self.metrics.enabled:
+            return self._next_batch()
+        start = time.perf_counter_ns()
+        if self._batch_returned_ns is not None:
+            self.metrics.record('wait_for_consumer', start - self._batch_returned_ns)
+        try:
+            batch = self._next_batch()
+        except StopIteration:
+            self._batch_returned_ns = None
+            raise
+        self._batch_returned_ns = time.perf_counter_ns()
+        self.metrics.record('batch', self._batch_returned_ns - start, items=len(batch))
+        return batch
+
+    def _next_batch(self):
+        if self._prefetcher is None and (self._stream if self.streaming else self._order) is None:
+            iter(self)
+        if self._prefetcher is not None:
+            return next(self._prefetcher)
+        return self._load_batch()
+
+    def _load_batches(self):
+        # Runs on the prefetch thread
+        while True:
+            try:
+                yield self._load_batch()
+            except StopIteration:
+                return
+
+    def _load_batch(self):
+        if self.streaming:
+            batch = next(self._stream)
+            self.index += len(batch)
+            return self.collate(batch)
+        if self.index < len(self._order):
+            if self._batch_ends is None:
+                end = self.index + self.batch_size
+            else:
+                end = self._batch_ends[np.searchsorted(self._batch_ends, self.index, side='right')]
+            batch = self.gather(self._order[self.index:end])
+            self.index = end
+            return self.collate(batch)
         else:
             raise StopIteration
 
+    def gather(self, indices: np.ndarray):
+        if not isinstance(self.data, ArrayData):
+            return [self.data[i] for i in indices]
+        # A run of consecutive indices is handed out as a zero-copy slice; other
+        # batches are read in ascending index order, so reads sweep a memory mapping
+        # forward, then put back in the order the sampler chose
+        indices = np.asarray(indices)
+        if len(indices) and np.all(np.diff(indices) == 1):
+            return self.data[int(indices[0]):int(indices[-1]) + 1]
+        ascending = np.argsort(indices, kind='stable')
+        return self.data[indices[ascending]][np.argsort(ascending)]
+
+    def collate(self, samples: List[DataSample]):
+        with self.metrics.span('collate', items=len(samples)):
+            batch = list(samples) if self.collate_fn is None else self.collate_fn(samples)
+        # Transforms run on the assembled batch, batched where they allow it
+        if self.transforms is not None:
+            with self.metrics.span('transform', items=len(batch)):
+                batch = self.transforms.apply_batch(batch)
+        if self.augmentations is not None:
+            with self.metrics.span('augment', items=len(batch)):
+                batch = self.augmentations.apply_batch(batch, rng=self.batch_rng())
+        return batch
+
+    def batch_rng(self) -> np.random.Generator:
+        # Streams are fixed by (seed, epoch, batch number), whichever thread collates
+        return np.random.default_rng([self._augment_seed, self._iteration_epoch, next(self._batch_counter)])
+
     @contextmanager
     def batch_context(self):
         try:
             yield self
         finally:
+            self.close()
             self.index = 0
 
+    def close(self):
+        # Stops the prefetch thread and the open stream, e.g. after a break
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    @cached_property
+    def sample_lengths(self) -> np.ndarray:
+        # Token count per sample, worked out once per version of the data
+        self.materialize()
+        return lengths_of(self.data)
+
     @cached_property
     def data_statistics(self):
-        if not self.data:
-            return None
-        
-        num_features = len(self.data[0].features)
-        feature_sums = [sum(sample.features[i] for sample in self.data) for i in range(num_features)]
-        feature_means = [sum_i / len(self.data) for sum_i in feature_sums]
-        
-        return {
-            "num_samples": len(self.data),
-            "num_features": num_features,
-            "feature_means": feature_means
-        }
+        # One pass over the data in collated chunks, which in streaming mode are
+        # read on the fly rather than held in memory
+        if self.streaming:
+            chunks = self.stream_batches()
+        else:
+            self.materialize()
+            chunks = self._chunks(self.data)
+        stats, num_samples = self._accumulate_statistics(chunks)
+        return self._set_statistics(stats, num_samples)
+
+    def _set_statistics(self, stats: RunningStats, num_samples: int):
+        # Kept with the version it describes, so refresh() can add rows to it
+        self._statistics_state = (self._version, stats, num_samples)
+        statistics = stats.as_dict(num_samples) if num_samples else None
+        type(self).data_statistics.__set__(self, statistics)
+        return statistics
+
+    def _chunks(self, data):
+        chunk_size = self.kwargs.get('statistics_chunk_size', 4096)
+        return (data[start:start + chunk_size] for start in range(0, len(data), chunk_size))
+
+    def _accumulate_statistics(self, chunks):
+        stats = RunningStats()
+        num_samples = 0
+        collator = Collator()
+        for chunk in chunks:
+            batch = collator(chunk)
+            num_samples += len(batch)
+            if isinstance(batch, Batch):
+                stats.update(batch.features, batch.labels)
+            elif isinstance(batch, PaddedBatch):
+                stats.update(labels=batch.labels)
+            else:
+                stats.update(labels=[sample.label for sample in batch])
+        return stats, num_samples
 
     def apply_transformation(self, transformation: Callable[[DataSample], DataSample]):
-        self.data = list(map(transformation, self.data))
+        # Recorded in the plan; a transformation with a batched implementation (see
+        # batch_transform) then maps whole feature arrays at once
+        self._plan = self._plan.map(transformation)
+        self._data_changed()
+
+    def filter_data(self, condition: Union[Callable[[DataSample], bool], np.ndarray]):
+        # condition is a per-sample predicate, possibly with a batched implementation
+        # mapping (features, labels) to a keep mask, or a boolean mask over the
+        # samples; a mask refers to the data as it is now, so the plan runs first
+        if isinstance(condition, np.ndarray):
+            self.materialize()
+            self.data = self._select(condition.astype(bool, copy=False))
+            if self._row_paths is not None:
+                self._row_paths = self._row_paths[condition.astype(bool, copy=False)]
+        else:
+            self._plan = self._plan.filter(condition)
+        self._data_changed()
+
+    def plan_key(self) -> str:
+        # Names the loaded data as transformed by the pending plan
+        return f'{self.records_key()}-{self._plan.fingerprint()[:16]}'
+
+    def materialize(self, num_workers=None):
+        # Runs the pending transformations and filters in one fused pass, which
+        # iteration does on its own; plan_workers=N runs it in a worker pool
+        if not self._plan or self.streaming:
+            return self
+        if num_workers is None:
+            num_workers = self.kwargs.get('plan_workers', 0)
+        with self.metrics.span('transform', items=len(self.data)):
+            if self.kwargs.get('cache'):
+                self.data = self._load_plan_records(num_workers)
+            elif self._row_paths is not None:
+                self.data, self._row_paths = self._plan.execute(self.data, self.kwargs.get('plan_chunk_size', 4096),
+                                                                num_workers, keys=self._row_paths)
+            else:
+                self.data = self._execute_plan(num_workers)
+        self._applied = Plan(self._applied.steps + self._plan.steps)
+        self._plan = Plan()
+        return self
+
+    def _execute_plan(self, num_workers):
+        return self._plan.execute(self.data, self.kwargs.get('plan_chunk_size', 4096), num_workers)
+
+    def _load_plan_records(self, num_workers):
+        # With cache=True the planned result is kept as records under plan_key()
+        key = self._cache_key(self.plan_key)
+        if key is None:
+            return self._execute_plan(num_workers)
+        path = DatasetCache(self.kwargs.get('cache_dir', 'datasets/.cache')).path(key)
+        try:
+            records = open_records(path)
+        except (OSError, ValueError):
+            records = None
+        if records is not None and records[1].get('key') == key:
+            return records[0]
+        data = self._execute_plan(num_workers)
+        if not isinstance(data, ArrayData) or data.offsets is not None or not len(data):
+            return data
+        try:
+            write_records(path, [(data.features, data.labels)], {'key': key})
+        except ValueError:
+            return data
+        return open_records(path)[0]
 
-    def filter_data(self, condition: Callable[[DataSample], bool]):
-        self.data = list(filter(condition, self.data))
+    def _data_changed(self):
+        # Invalidates cached properties such as data_statistics and the epoch order
+        self._version += 1
+        self.close()
+        self._order = None
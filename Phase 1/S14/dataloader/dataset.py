@@ -0,0 +1,120 @@
+# dataloader/dataset.py
+
+from collections import namedtuple
+from numbers import Number
+import numpy as np
+from .utils import batched
+
+DataSample = namedtuple('DataSample', ['features', 'label'])
+
+class ArrayData:
+    # Features and labels held as aligned arrays; indexing with an int gives a
+    # DataSample view, slicing, a mask or an index array gives another ArrayData.
+    # With offsets, features holds 1-d samples of varying length back to back:
+    # sample i is features[offsets[i]:offsets[i + 1]]
+    def __init__(self, features: np.ndarray, labels: np.ndarray, offsets: np.ndarray = None):
+        self.features = features
+        self.labels = labels
+        self.offsets = offsets
+
+    @classmethod
+    def concatenate(cls, chunks):
+        chunks = [chunk if isinstance(chunk, ArrayData) else cls(*chunk) for chunk in chunks]
+        if not chunks:
+            return cls(np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64))
+        if len(chunks) == 1:
+            return chunks[0]
+        labels = np.concatenate([chunk.labels for chunk in chunks])
+        if all(chunk.offsets is None and chunk.features.shape[1:] == chunks[0].features.shape[1:] for chunk in chunks):
+            return cls(np.concatenate([chunk.features for chunk in chunks]), labels)
+        # Mixed lengths: every chunk is stored flat
+        chunks = [chunk.ragged() for chunk in chunks]
+        starts = np.cumsum([0] + [len(chunk.features) for chunk in chunks])
+        offsets = np.concatenate([chunk.offsets[:-1] + start for chunk, start in zip(chunks, starts)] + [starts[-1:]])
+        return cls(np.concatenate([chunk.features for chunk in chunks]), labels, offsets)
+
+    @classmethod
+    def from_samples(cls, samples):
+        # Packs a batch of samples; lists of numbers become float32, as in
+        # collation, while other lists (e.g. tokens) are not numeric features
+        features = [_numeric_array(sample.features) for sample in samples]
+        labels = np.asarray([sample.label for sample in samples])
+        if all(f.shape == features[0].shape for f in features):
+            return cls(np.stack(features), labels)
+        if any(f.ndim != 1 for f in features):
+            raise ValueError("array storage needs features of a fixed shape, or 1-d")
+        offsets = np.cumsum([0] + [len(f) for f in features], dtype=np.int64)
+        return cls(np.concatenate(features), labels, offsets)
+
+    def ragged(self):
+        if self.offsets is not None:
+            return self
+        if self.features.ndim != 2:
+            raise ValueError("only 1-d samples can be stored with offsets")
+        width = self.features.shape[1]
+        return ArrayData(self.features.reshape(-1), self.labels, np.arange(len(self) + 1, dtype=np.int64) * width)
+
+    def lengths(self) -> np.ndarray:
+        if self.offsets is None:
+            return np.full(len(self), self.features.shape[1] if self.features.ndim > 1 else 1, dtype=np.int64)
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if self.offsets is None:
+                return DataSample(features=self.features[key], label=self.labels[key])
+            i = range(len(self))[key]
+            return DataSample(features=self.features[self.offsets[i]:self.offsets[i + 1]], label=self.labels[i])
+        if self.offsets is None:
+            return ArrayData(self.features[key], self.labels[key])
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            stop = max(start, stop)
+            return ArrayData(self.features[self.offsets[start]:self.offsets[stop]], self.labels[start:stop],
+                             self.offsets[start:stop + 1] - self.offsets[start])
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        # Gather the selected runs with one fancy index over the flat features
+        lengths = self.lengths()[key]
+        offsets = np.zeros(len(key) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(self.offsets[key] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return ArrayData(self.features[positions], self.labels[key], offsets)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def _numeric_array(features) -> np.ndarray:
+    if isinstance(features, np.ndarray):
+        numeric = np.issubdtype(features.dtype, np.number)
+    else:
+        numeric = isinstance(features, Number) or (
+            isinstance(features, (list, tuple)) and all(isinstance(x, Number) for x in features))
+        features = np.asarray(features, dtype=np.float32) if numeric else features
+    if not numeric:
+        raise ValueError("array storage needs numeric features")
+    return features
+
+def pack_samples(samples, chunk_size=4096):
+    # ArrayData when every sample has numeric features of a fixed shape (or 1-d),
+    # else the samples as a list; only one chunk of samples is held as objects
+    samples = iter(samples)
+    chunks = []
+    for batch in batched(samples, chunk_size):
+        try:
+            chunks.append(ArrayData.from_samples(batch))
+        except ValueError:
+            return [sample for chunk in chunks for sample in chunk] + batch + list(samples)
+    if not chunks:
+        return []
+    try:
+        return ArrayData.concatenate(chunks)
+    except ValueError:
+        return [sample for chunk in chunks for sample in chunk]
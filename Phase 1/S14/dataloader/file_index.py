@@ -0,0 +1,166 @@
+# dataloader/file_index.py
+
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+
+def _scan_directory(path):
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return os.stat(path).st_mtime_ns, sorted(files), subdirs
+
+class FileIndex:
+    # Manifest of every file under root as parallel arrays (directory id, name,
+    # size, mtime), plus each directory's own mtime. Directories are scanned with
+    # os.scandir from a thread pool; update() rescans only directories whose
+    # mtime moved, which catches added, removed and renamed files. A file
+    # rewritten in place leaves its directory's mtime alone; restat() catches it
+    def __init__(self, root, dirs=None, dir_mtimes=None, dir_ids=None, names=None, sizes=None, mtimes=None):
+        self.root = root
+        self.dirs = [str(d) for d in dirs] if dirs is not None else []
+        self.dir_mtimes = np.asarray(dir_mtimes if dir_mtimes is not None else [], dtype=np.int64)
+        self.dir_ids = np.asarray(dir_ids if dir_ids is not None else [], dtype=np.int32)
+        self.names = np.asarray(names if names is not None else [], dtype=str)
+        self.sizes = np.asarray(sizes if sizes is not None else [], dtype=np.int64)
+        self.mtimes = np.asarray(mtimes if mtimes is not None else [], dtype=np.int64)
+
+    @staticmethod
+    def default_path(root):
+        return f'{root.rstrip(os.sep)}.index.npz'
+
+    @classmethod
+    def build(cls, root, threads=8):
+        index = cls(root)
+        index._rebuild(index._scan({'.'}, threads, {}))
+        return index
+
+    @classmethod
+    def load(cls, root, path=None):
+        with np.load(path or cls.default_path(root)) as manifest:
+            return cls(root, **{name: manifest[name] for name in manifest.files})
+
+    @classmethod
+    def load_or_build(cls, root, path=None, threads=8, restat=False):
+        path = path or cls.default_path(root)
+        if os.path.exists(path):
+            index = cls.load(root, path)
+            changed = index.update(threads)
+            if restat:
+                changed = index.restat(threads) or changed
+            if not changed:
+                return index
+        else:
+            index = cls.build(root, threads)
+        index.save(path)
+        return index
+
+    def save(self, path=None):
+        path = path or self.default_path(self.root)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, dirs=np.asarray(self.dirs, dtype=str), dir_mtimes=self.dir_mtimes,
+                 dir_ids=self.dir_ids, names=self.names, sizes=self.sizes, mtimes=self.mtimes)
+        os.replace(tmp_path, path)
+
+    def update(self, threads=8):
+        # Re-stat the known directories (in parallel) and rescan those that changed
+        def changed(i):
+            try:
+                return os.stat(os.path.join(self.root, self.dirs[i])).st_mtime_ns != self.dir_mtimes[i]
+            except FileNotFoundError:
+                return True
+        with ThreadPoolExecutor(threads) as executor:
+            stale = [d for d, is_changed in zip(self.dirs, executor.map(changed, range(len(self.dirs)))) if is_changed]
+        if not stale:
+            return False
+        kept = self._entries_by_dir()
+        for directory in stale:
+            kept.pop(directory, None)
+        self._rebuild(self._scan(set(stale), threads, kept))
+        return True
+
+    def restat(self, threads=8):
+        # Re-stat every indexed file (in parallel), picking up new sizes and mtimes
+        # of files rewritten in place; files gone since are dropped
+        paths = [os.path.join(self.root, self.dirs[dir_id], name)
+                 for dir_id, name in zip(self.dir_ids.tolist(), self.names.tolist())]
+
+        def stat(path):
+            try:
+                result = os.stat(path)
+                return result.st_size, result.st_mtime_ns
+            except FileNotFoundError:
+                return -1, -1
+        with ThreadPoolExecutor(threads) as executor:
+            stats = np.array(list(executor.map(stat, paths)), dtype=np.int64).reshape(-1, 2)
+        sizes, mtimes = stats[:, 0], stats[:, 1]
+        if np.array_equal(sizes, self.sizes) and np.array_equal(mtimes, self.mtimes):
+            return False
+        kept = sizes >= 0
+        self.dir_ids, self.names = self.dir_ids[kept], self.names[kept]
+        self.sizes, self.mtimes = sizes[kept], mtimes[kept]
+        return True
+
+    def _entries_by_dir(self):
+        entries = {d: (self.dir_mtimes[i], []) for i, d in enumerate(self.dirs)}
+        for dir_id, name, size, mtime in zip(self.dir_ids, self.names, self.sizes, self.mtimes):
+            entries[self.dirs[dir_id]][1].append((str(name), int(size), int(mtime)))
+        return entries
+
+    def _scan(self, starts, threads, known):
+        # known maps unchanged directories to (mtime, files). New subdirectories
+        # of rescanned directories get scanned too; deleted ones fail to stat as
+        # stale directories and drop out here
+        results = dict(known)
+        with ThreadPoolExecutor(threads) as executor:
+            pending = {}
+
+            def submit(directory):
+                pending[executor.submit(_scan_directory, os.path.join(self.root, directory))] = directory
+
+            for directory in starts:
+                submit(directory)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory = pending.pop(future)
+                    try:
+                        mtime, files, subdirs = future.result()
+                    except FileNotFoundError:
+                        continue
+                    results[directory] = (mtime, files)
+                    for subdir in subdirs:
+                        child = os.path.normpath(os.path.join(directory, subdir))
+                        if child not in results:
+                            submit(child)
+        return results
+
+    def _rebuild(self, results):
+        self.dirs = sorted(results)
+        dir_ids, names, sizes, mtimes = [], [], [], []
+        for dir_id, directory in enumerate(self.dirs):
+            for name, size, mtime in results[directory][1]:
+                dir_ids.append(dir_id)
+                names.append(name)
+                sizes.append(size)
+                mtimes.append(mtime)
+        self.dir_mtimes = np.array([results[d][0] for d in self.dirs], dtype=np.int64)
+        self.dir_ids = np.array(dir_ids, dtype=np.int32)
+        self.names = np.array(names, dtype=str)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.mtimes = np.array(mtimes, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def entries(self):
+        # (path, label, size, mtime_ns) per file; the label is the directory's name
+        dir_paths = [os.path.normpath(os.path.join(self.root, d)) for d in self.dirs]
+        for dir_id, name, size, mtime in zip(self.dir_ids.tolist(), self.names.tolist(),
+                                             self.sizes.tolist(), self.mtimes.tolist()):
+            yield os.path.join(dir_paths[dir_id], name), os.path.basename(dir_paths[dir_id]), size, mtime
@@ -0,0 +1,64 @@
+# dataloader/images.py
+
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+
+def decode_image(path: str, size=None, mode=None, dtype=np.uint8) -> np.ndarray:
+    # With a target size (width, height), JPEGs are decoded at a reduced scale via
+    # draft() and other formats shrunk by whole factors with reduce() before the
+    # final resize, so full-resolution pixels are rarely materialized
+    with Image.open(path) as img:
+        if size is not None:
+            img.draft(mode or img.mode, size)
+        if mode is not None and img.mode != mode:
+            img = img.convert(mode)
+        if size is not None and img.size != tuple(size):
+            factor = min(img.width // size[0], img.height // size[1])
+            if factor >= 2:
+                img = img.reduce(factor)
+            img = img.resize(tuple(size), Image.BILINEAR)
+        return np.asarray(img, dtype=dtype)
+
+# Batched geometry on (N, H, W, ...) arrays: each operation computes one
+# nearest-neighbour index map for the whole batch and gathers through it
+
+@lru_cache(maxsize=32)
+def _rotation_map(height, width, angle):
+    # Source pixel for every output pixel when rotating counter-clockwise about the
+    # centre, as PIL's Image.rotate does; points outside the source are masked
+    theta = np.deg2rad(angle)
+    cy, cx = (height - 1) / 2, (width - 1) / 2
+    y, x = np.mgrid[0:height, 0:width]
+    dx, dy = x - cx, y - cy
+    src_x = np.rint(cx + dx * np.cos(theta) - dy * np.sin(theta)).astype(np.intp)
+    src_y = np.rint(cy + dx * np.sin(theta) + dy * np.cos(theta)).astype(np.intp)
+    inside = (src_x >= 0) & (src_x < width) & (src_y >= 0) & (src_y < height)
+    return np.clip(src_y, 0, height - 1), np.clip(src_x, 0, width - 1), inside
+
+def rotate_batch(images: np.ndarray, angle: float) -> np.ndarray:
+    src_y, src_x, inside = _rotation_map(images.shape[1], images.shape[2], float(angle))
+    rotated = images[:, src_y, src_x]
+    rotated[:, ~inside] = 0
+    return rotated
+
+def resize_batch(images: np.ndarray, size) -> np.ndarray:
+    width, height = size
+    rows = (np.arange(height) * images.shape[1] // height).astype(np.intp)
+    cols = (np.arange(width) * images.shape[2] // width).astype(np.intp)
+    return images[:, rows[:, None], cols]
+
+def center_crop_batch(images: np.ndarray, size) -> np.ndarray:
+    width, height = size
+    top, left = (images.shape[1] - height) // 2, (images.shape[2] - width) // 2
+    return images[:, top:top + height, left:left + width]
+
+def random_crop_batch(images: np.ndarray, size, rng=None) -> np.ndarray:
+    width, height = size
+    n = len(images)
+    rng = rng or np.random.default_rng()
+    tops = rng.integers(0, images.shape[1] - height + 1, size=n)
+    lefts = rng.integers(0, images.shape[2] - width + 1, size=n)
+    rows = tops[:, None] + np.arange(height)
+    cols = lefts[:, None] + np.arange(width)
+    return images[np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
@@ -0,0 +1,102 @@
+# dataloader/plan.py
+
+import hashlib
+import numpy as np
+from .dataset import ArrayData, pack_samples
+from .utils import function_fingerprint
+from .workers import make_pool, parallel_map, process_chunk
+
+class Plan:
+    # Transformations and filters recorded by apply_transformation / filter_data,
+    # run later in one pass: each chunk of the data goes through every step before
+    # the next chunk is read, so no step makes a full copy of the dataset
+    def __init__(self, steps=()):
+        self.steps = tuple(steps)
+
+    def map(self, transformation):
+        return Plan(self.steps + (('map', transformation),))
+
+    def filter(self, condition):
+        return Plan(self.steps + (('filter', condition),))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def fingerprint(self) -> str:
+        digest = hashlib.sha1()
+        for kind, func in self.steps:
+            digest.update(f'{kind}:{function_fingerprint(func)};'.encode())
+        return digest.hexdigest()
+
+    def __call__(self, sample):
+        # The fused per-sample function; None for a sample that is filtered out
+        for kind, func in self.steps:
+            if kind == 'map':
+                sample = func(sample)
+            elif not func(sample):
+                return None
+        return sample
+
+    def run_chunk(self, chunk, keys=None):
+        # keys (e.g. the file each sample came from) is an optional array aligned
+        # with chunk that filters keep in step; given keys, returns (chunk, keys)
+        if isinstance(chunk, ArrayData) and chunk.offsets is None:
+            # Batched steps see the data as it is stored, read-only, so one working
+            # in place (see writable_float32) copies it first
+            features = chunk.features.view()
+            features.flags.writeable = False
+            chunk = ArrayData(features, chunk.labels)
+        for i, (kind, func) in enumerate(self.steps):
+            if not isinstance(chunk, ArrayData):
+                # Steps after one that left arrays behind run per sample
+                samples = list(map(Plan(self.steps[i:]), chunk))
+                kept = np.array([sample is not None for sample in samples], dtype=bool)
+                chunk = [sample for sample in samples if sample is not None]
+                keys = None if keys is None else keys[kept]
+                break
+            chunk, kept = self._run_step(kind, func, chunk)
+            if kept is not None and keys is not None:
+                keys = keys[kept]
+        return chunk if keys is None else (chunk, keys)
+
+    @staticmethod
+    def _run_step(kind, func, chunk: ArrayData):
+        # (result, mask of the samples kept); steps with a batched implementation
+        # (see batch_transform) see whole arrays
+        batched = chunk.offsets is None and hasattr(func, 'batch')
+        if kind == 'map':
+            if batched:
+                return ArrayData(func.batch(chunk.features), chunk.labels), None
+            return pack_samples(map(func, chunk)), None
+        if batched:
+            kept = np.asarray(func.batch(chunk.features, chunk.labels), dtype=bool)
+        else:
+            kept = np.fromiter((bool(func(sample)) for sample in chunk), dtype=bool, count=len(chunk))
+        return chunk[kept], kept
+
+    def _run_task(self, task):
+        return self.run_chunk(*task)
+
+    def execute(self, data, chunk_size=4096, num_workers=0, keys=None):
+        if not self.steps or not len(data):
+            return data if keys is None else (data, keys)
+        tasks = ((data[start:start + chunk_size], None if keys is None else keys[start:start + chunk_size])
+                 for start in range(0, len(data), chunk_size))
+        if num_workers:
+            with make_pool(num_workers, None, self._run_task) as pool:
+                results = list(parallel_map(pool, process_chunk, tasks, max_in_flight=num_workers + 2))
+        else:
+            results = [self.run_chunk(*task) for task in tasks]
+        if keys is not None:
+            results, key_chunks = zip(*results)
+            return join_chunks(results), np.concatenate(key_chunks)
+        return join_chunks(results)
+
+def join_chunks(chunks):
+    # One ArrayData when the chunks stack, else a list of samples
+    if all(isinstance(chunk, ArrayData) for chunk in chunks):
+        try:
+            return ArrayData.concatenate(chunks)
+        except ValueError:
+            pass
+    return [sample for chunk in chunks for sample in chunk]
@@ -1,28 +1,212 @@
 # dataloader/preprocessors.py
 
 import numpy as np
-from PIL import Image
+from .collate import Batch, PaddedBatch
+from .images import center_crop_batch, random_crop_batch, resize_batch, rotate_batch
+from .stats import RunningStats
+
+# A transform maps one DataSample to another. It may also declare a batched
+# implementation (see batch_transform) that maps a whole (N, ...) feature array
+# at once, of whatever dtype it is stored in; one that needs float32, or works
+# in place, gets its array through writable_float32. A filter_data condition may
+# declare one too, mapping (features, labels) arrays to a boolean keep mask.
+# Random transforms (see random_transform) draw from a NumPy Generator given as
+# rng=, which lets the DataLoader seed them per epoch and batch.
+
+def batch_transform(batch_func):
+    def decorator(func):
+        func.batch = batch_func
+        return func
+    return decorator
+
+def random_transform(func):
+    func.random = True
+    return func
 
 def default_preprocess(sample):
     return sample
 
+def writable_float32(features):
+    # The features themselves when they can be worked on in place, else a float32 copy
+    if isinstance(features, np.ndarray) and features.dtype == np.float32 and features.flags.writeable:
+        return features
+    return np.array(features, dtype=np.float32)
+
+def normalize_batch(features):
+    features = writable_float32(features)
+    features *= np.float32(1 / 255.0)
+    return features
+
+@batch_transform(normalize_batch)
 def normalize(sample):
-    features = np.array(sample.features).astype(np.float32) / 255.0
-    return DataSample(features=features, label=sample.label)
+    if not hasattr(sample, 'features'):
+        # Bare values and arrays are normalized directly
+        return normalize_batch(np.asarray(sample, dtype=np.float32))
+    features = np.array(sample.features, dtype=np.float32)
+    return sample._replace(features=normalize_batch(features))
+
+def normalize_features(statistics, method='standard'):
+    # Per-feature scaling fitted once from statistics gathered in a single pass
+    # (a RunningStats, or the data_statistics dict): method='standard' gives zero
+    # mean and unit variance, 'minmax' maps [min, max] to [0, 1]. Batches are
+    # scaled in place; image features are scaled per pixel
+    if isinstance(statistics, RunningStats):
+        statistics = statistics.as_dict()
+    if method == 'standard':
+        shift = np.asarray(statistics['feature_means'])
+        spread = np.sqrt(statistics['feature_variances'])
+    elif method == 'minmax':
+        shift = np.asarray(statistics['feature_min'])
+        spread = np.asarray(statistics['feature_max']) - shift
+    else:
+        raise ValueError(f"unknown normalization method: {method}")
+    shift = shift.astype(np.float32)
+    # Constant features are only shifted
+    scale = np.where(spread > 0, 1 / np.where(spread > 0, spread, 1), 1).astype(np.float32)
+
+    def scale_batch(features):
+        features = writable_float32(features)
+        shape = features.shape[1:]
+        features -= shift.reshape(shape)
+        features *= scale.reshape(shape)
+        return features
+
+    @batch_transform(scale_batch)
+    def scale_features(sample):
+        return sample._replace(features=scale_batch(np.array(sample.features, dtype=np.float32)[None])[0])
+    return scale_features
+
+def select_features(columns=None, feature_names=None, statistics=None, min_variance=None):
+    # Keeps the given columns (indices, or names looked up in feature_names, e.g.
+    # DataLoader.feature_names), or with statistics and min_variance the features
+    # whose variance exceeds min_variance. Features are taken flattened, so for
+    # images a column is a pixel. Evenly spaced columns project as a view
+    if columns is not None:
+        index = np.array([feature_names.index(c) if isinstance(c, str) else c for c in columns], dtype=np.intp)
+    elif statistics is not None and min_variance is not None:
+        if isinstance(statistics, RunningStats):
+            statistics = statistics.as_dict()
+        index = np.flatnonzero(np.asarray(statistics['feature_variances']) > min_variance)
+    else:
+        raise ValueError("select_features needs columns, or statistics and min_variance")
+    index = _as_slice(index)
+
+    def select_batch(features):
+        features = np.asarray(features)
+        return features.reshape(len(features), -1)[:, index]
+
+    @batch_transform(select_batch)
+    def select(sample):
+        return sample._replace(features=np.asarray(sample.features).reshape(-1)[index])
+    return select
 
-def augment(sample):
+def _as_slice(index):
+    steps = np.diff(index)
+    if len(index) and index[0] >= 0 and (steps > 0).all() and (steps == steps[:1]).all():
+        return slice(int(index[0]), int(index[-1]) + 1, int(steps[0]) if len(steps) else 1)
+    return index
+
+def augment_batch(features, rng=None):
+    if rng is None:
+        return rotate_batch(features, 10)
+    # A random whole-degree angle in [-10, 10] per image; whole degrees keep the
+    # number of distinct rotation maps small enough to stay cached
+    angles = rng.integers(-10, 11, size=len(features))
+    rotated = np.empty_like(features)
+    for angle in np.unique(angles):
+        chosen = angles == angle
+        rotated[chosen] = rotate_batch(features[chosen], angle)
+    return rotated
+
+@random_transform
+@batch_transform(augment_batch)
+def augment(sample, rng=None):
     if isinstance(sample.features, np.ndarray):
-        # Image augmentation
-        img = Image.fromarray(sample.features.astype('uint8'), 'RGB')
-        img = img.rotate(10)  # Rotate by 10 degrees
-        return DataSample(features=np.array(img), label=sample.label)
+        # Image augmentation: rotate by up to 10 degrees (by exactly 10 without an
+        # rng), as a batch of one
+        return sample._replace(features=augment_batch(sample.features[None], rng)[0])
     else:
         # Text augmentation (example: add noise)
-        features = sample.features + ' ' + ''.join(np.random.choice(list('abcdefghijklmnopqrstuvwxyz'), size=5))
-        return DataSample(features=features, label=sample.label)
+        choice = np.random.choice if rng is None else rng.choice
+        features = sample.features + ' ' + ''.join(choice(list('abcdefghijklmnopqrstuvwxyz'), size=5))
+        return sample._replace(features=features)
+
+def resize(size):
+    # Nearest-neighbour resize of image features to size (width, height)
+    def resize_images(features):
+        return resize_batch(np.asarray(features), size)
+
+    @batch_transform(resize_images)
+    def resize_image(sample):
+        return sample._replace(features=resize_images(np.asarray(sample.features)[None])[0])
+    return resize_image
+
+def center_crop(size):
+    # Crops image features to size (width, height) about the centre
+    def crop_images(features):
+        return center_crop_batch(np.asarray(features), size)
+
+    @batch_transform(crop_images)
+    def crop_image(sample):
+        return sample._replace(features=crop_images(np.asarray(sample.features)[None])[0])
+    return crop_image
+
+def random_crop(size):
+    # Crops image features to size (width, height) at a random position per image
+    def crop_images(features, rng=None):
+        return random_crop_batch(np.asarray(features), size, rng)
+
+    @random_transform
+    @batch_transform(crop_images)
+    def crop_image(sample, rng=None):
+        return sample._replace(features=crop_images(np.asarray(sample.features)[None], rng)[0])
+    return crop_image
 
 def tokenize(sample):
     if isinstance(sample.features, str):
         tokens = sample.features.split()
-        return DataSample(features=tokens, label=sample.label)
+        return sample._replace(features=tokens)
     return sample
+
+class Pipeline:
+    def __init__(self, *transforms, reuse_buffers=False):
+        self.transforms = transforms
+        self.reuse_buffers = reuse_buffers
+        self._buffer = None
+
+    def __call__(self, sample, rng=None):
+        for transform in self.transforms:
+            sample = transform(sample, **self._random_args(transform, rng))
+        return sample
+
+    def apply_batch(self, batch, rng=None):
+        if isinstance(batch, PaddedBatch):
+            raise TypeError("transforms do not apply to padded token batches")
+        if not isinstance(batch, Batch):
+            return [self(sample, rng) for sample in batch]
+        features = self._owned_buffer(batch.features)
+        for transform in self.transforms:
+            kwargs = self._random_args(transform, rng)
+            if hasattr(transform, 'batch'):
+                features = transform.batch(features, **kwargs)
+            else:
+                features = np.stack([transform(sample, **kwargs).features
+                                     for sample in Batch(features, batch.labels).samples()])
+        return batch._replace(features=features)
+
+    @staticmethod
+    def _random_args(transform, rng):
+        return {'rng': rng} if rng is not None and getattr(transform, 'random', False) else {}
+
+    def _owned_buffer(self, features):
+        # One float32 copy per batch, optionally into a buffer reused across batches;
+        # batched transforms may then work in place even when the batch views
+        # read-only (e.g. memory-mapped) data
+        shape = features.shape
+        if not self.reuse_buffers:
+            return np.array(features, dtype=np.float32)
+        if self._buffer is None or self._buffer.shape[1:] != shape[1:] or len(self._buffer) < len(features):
+            self._buffer = np.empty(shape, dtype=np.float32)
+        buffer = self._buffer[:len(features)]
+        np.copyto(buffer, features, casting='unsafe')
+        return buffer
@@ -0,0 +1,126 @@
+# dataloader/samplers.py
+
+import numpy as np
+from .dataset import ArrayData
+
+# A sampler turns a dataset into the order of sample indices for one epoch.
+# Seeded samplers derive their generator from (seed, epoch), so every epoch is
+# reproducible and differs from the others.
+
+def labels_of(data) -> np.ndarray:
+    if isinstance(data, ArrayData):
+        return np.asarray(data.labels)
+    return np.array([sample.label for sample in data])
+
+def epoch_rng(seed, epoch):
+    return np.random.default_rng(None if seed is None else [seed, epoch])
+
+class Sampler:
+    def indices(self, data, epoch=0) -> np.ndarray:
+        raise NotImplementedError
+
+class SequentialSampler(Sampler):
+    def indices(self, data, epoch=0):
+        return np.arange(len(data))
+
+class RandomSampler(Sampler):
+    def __init__(self, seed=None):
+        self.seed = seed
+
+    def indices(self, data, epoch=0):
+        return epoch_rng(self.seed, epoch).permutation(len(data))
+
+class WeightedRandomSampler(Sampler):
+    def __init__(self, weights, num_samples=None, replacement=True, seed=None):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.num_samples = num_samples
+        self.replacement = replacement
+        self.seed = seed
+
+    def indices(self, data, epoch=0):
+        if len(self.weights) != len(data):
+            raise ValueError(f"got {len(self.weights)} weights for {len(data)} samples")
+        num_samples = len(data) if self.num_samples is None else self.num_samples
+        return epoch_rng(self.seed, epoch).choice(len(data), size=num_samples, replace=self.replacement,
+                                                  p=self.weights / self.weights.sum())
+
+class StratifiedSampler(Sampler):
+    # Shuffles within each label, then interleaves the labels so that any run of
+    # consecutive indices, and hence every batch, keeps the overall label mix
+    def __init__(self, seed=None):
+        self.seed = seed
+
+    def indices(self, data, epoch=0):
+        rng = epoch_rng(self.seed, epoch)
+        labels = labels_of(data)
+        positions = np.empty(len(labels))
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            rng.shuffle(members)
+            positions[members] = (np.arange(len(members)) + rng.random()) / len(members)
+        return np.argsort(positions, kind='stable')
+
+class DistributedSampler(Sampler):
+    # Every rank draws the same permutation from the shared seed and keeps every
+    # num_replicas-th index from its rank on, so shards are disjoint and cover the data
+    def __init__(self, num_replicas, rank, shuffle=True, seed=0):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank {rank} is out of range for {num_replicas} replicas")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+
+    def indices(self, data, epoch=0):
+        order = epoch_rng(self.seed, epoch).permutation(len(data)) if self.shuffle else np.arange(len(data))
+        return order[self.rank::self.num_replicas]
+
+def lengths_of(data) -> np.ndarray:
+    # Token count per sample: array lengths, list lengths, or whitespace-split words
+    if isinstance(data, ArrayData):
+        return data.lengths()
+    return np.fromiter((len(sample.features.split()) if isinstance(sample.features, str) else len(sample.features)
+                        for sample in data), dtype=np.int64, count=len(data))
+
+class BatchSampler(Sampler):
+    # Decides the batches themselves, from the sample lengths (see lengths_of),
+    # rather than an order the DataLoader cuts into batch_size pieces
+    def batches(self, lengths: np.ndarray, epoch=0) -> list:
+        raise NotImplementedError
+
+    def indices(self, data, epoch=0):
+        batches = self.batches(lengths_of(data), epoch)
+        return np.concatenate(batches) if batches else np.empty(0, dtype=np.intp)
+
+class BucketBatchSampler(BatchSampler):
+    # Groups samples of similar length so padded batches carry little padding: each
+    # epoch shuffles the indices, sorts them by length within pools of pool_size
+    # (the whole dataset by default, ties in random order), cuts batches whose
+    # padded size (longest sample x batch size) stays within max_tokens, and
+    # shuffles the batch order. A sample longer than max_tokens is a batch of its own
+    def __init__(self, max_tokens, max_batch_size=None, pool_size=None, shuffle=True, seed=None):
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+
+    def batches(self, lengths, epoch=0):
+        rng = epoch_rng(self.seed, epoch)
+        lengths = np.asarray(lengths)
+        order = rng.permutation(len(lengths)) if self.shuffle else np.arange(len(lengths))
+        pools = np.arange(len(lengths)) // (self.pool_size or max(len(lengths), 1))
+        order = order[np.lexsort((lengths[order], pools))]
+        batches, start, longest = [], 0, 0
+        for i, length in enumerate(lengths[order].tolist()):
+            longest = max(longest, length)
+            size = i - start + 1
+            if size > 1 and (longest * size > self.max_tokens
+                             or (self.max_batch_size is not None and size > self.max_batch_size)):
+                batches.append(order[start:i])
+                start, longest = i, length
+        if start < len(order):
+            batches.append(order[start:])
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
@@ -0,0 +1,103 @@
+# dataloader/shards.py
+
+import argparse
+import mmap
+import os
+import numpy as np
+from .dataset import DataSample
+
+# A packed corpus is a directory of large shard files holding the documents back
+# to back, plus shards.index.npz with each document's shard, offset, length and
+# label. Reading it is a few large sequential reads instead of an open() per file.
+SHARD_INDEX = 'shards.index.npz'
+
+def pack_text_corpus(src_dir: str, out_dir: str, shard_bytes=64 * 1024 * 1024) -> int:
+    # Labels come from each file's directory name, as in DataLoader._read_unstructured_data
+    os.makedirs(out_dir, exist_ok=True)
+    shard_ids, offsets, lengths, label_ids, sources = [], [], [], [], []
+    labels = {}
+    shard, shard_id, shard_size = None, -1, 0
+    try:
+        for root, dirs, files in os.walk(src_dir):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                with open(path, 'rb') as f:
+                    content = f.read()
+                if shard is None or (shard_size + len(content) > shard_bytes and shard_size):
+                    if shard is not None:
+                        shard.close()
+                    shard_id += 1
+                    shard = open(os.path.join(out_dir, f'shard-{shard_id:05d}.bin'), 'wb')
+                    shard_size = 0
+                shard.write(content)
+                shard_ids.append(shard_id)
+                offsets.append(shard_size)
+                lengths.append(len(content))
+                label_ids.append(labels.setdefault(os.path.basename(root), len(labels)))
+                sources.append(os.path.relpath(path, src_dir))
+                shard_size += len(content)
+    finally:
+        if shard is not None:
+            shard.close()
+    np.savez(os.path.join(out_dir, SHARD_INDEX), shard_ids=np.array(shard_ids, dtype=np.int32),
+             offsets=np.array(offsets, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+             label_ids=np.array(label_ids, dtype=np.int32), labels=np.array(list(labels), dtype=str),
+             sources=np.array(sources, dtype=str))
+    return len(offsets)
+
+def is_packed(data_path: str) -> bool:
+    return os.path.isfile(os.path.join(data_path, SHARD_INDEX))
+
+class ShardedCorpus:
+    def __init__(self, data_path: str, encoding='utf-8'):
+        self.data_path = data_path
+        self.encoding = encoding
+        with np.load(os.path.join(data_path, SHARD_INDEX)) as index:
+            self.shard_ids = index['shard_ids']
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+            self.label_ids = index['label_ids']
+            self.labels = index['labels'].tolist()
+            self.sources = index['sources']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _shard(self, shard_id):
+        # Shards are memory-mapped on first use and stay mapped
+        shard = self._maps.get(shard_id)
+        if shard is None:
+            with open(os.path.join(self.data_path, f'shard-{shard_id:05d}.bin'), 'rb') as f:
+                shard = self._maps[shard_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if os.fstat(f.fileno()).st_size else b''
+        return shard
+
+    def sample(self, i: int) -> DataSample:
+        start = self.offsets[i]
+        raw = self._shard(int(self.shard_ids[i]))[start:start + self.lengths[i]]
+        return DataSample(features=raw.decode(self.encoding), label=self.labels[self.label_ids[i]])
+
+    def __iter__(self):
+        # Documents are stored in index order, so this sweeps each shard front to back
+        for i in range(len(self)):
+            yield self.sample(i)
+
+    def close(self):
+        for shard in self._maps.values():
+            if isinstance(shard, mmap.mmap):
+                shard.close()
+        self._maps.clear()
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a directory of text files into shards")
+    parser.add_argument("src_dir", help="Corpus directory, one subdirectory per label")
+    parser.add_argument("out_dir", help="Directory to write shards and index to")
+    parser.add_argument("--shard_mb", type=int, default=64, help="Shard size in MiB (default: 64)")
+    args = parser.parse_args()
+    count = pack_text_corpus(args.src_dir, args.out_dir, args.shard_mb * 1024 * 1024)
+    print(f"Packed {count} documents into {args.out_dir}")
+
+if __name__ == '__main__':
+    main()
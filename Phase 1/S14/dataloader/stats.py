@@ -0,0 +1,73 @@
+# dataloader/stats.py
+
+import numpy as np
+
+class RunningStats:
+    # Per-feature count/mean/variance/min/max and a label histogram, accumulated a
+    # batch at a time: each batch is reduced with NumPy, then folded in with Chan's
+    # parallel form of Welford's update, which is also how partial results merge
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.label_counts = {}
+
+    def update(self, features=None, labels=None):
+        if labels is not None:
+            values, counts = np.unique(np.asarray(labels), return_counts=True)
+            self._add_labels(zip(values.tolist(), counts.tolist()))
+        if features is None or not len(features):
+            return self
+        x = np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+        batch = RunningStats()
+        batch.count = len(x)
+        batch.mean = x.mean(axis=0)
+        batch.m2 = np.square(x - batch.mean).sum(axis=0)
+        batch.min = x.min(axis=0)
+        batch.max = x.max(axis=0)
+        return self._merge_moments(batch)
+
+    def merge(self, other: 'RunningStats'):
+        self._add_labels(other.label_counts.items())
+        return self._merge_moments(other)
+
+    def _add_labels(self, counts):
+        for label, count in counts:
+            self.label_counts[label] = self.label_counts.get(label, 0) + count
+
+    def _merge_moments(self, other):
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            self.min, self.max = other.min.copy(), other.max.copy()
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / total)
+        self.m2 = self.m2 + other.m2 + np.square(delta) * (self.count * other.count / total)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.count = total
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else None
+
+    def as_dict(self, num_samples=None):
+        stats = {
+            "num_samples": self.count if num_samples is None else num_samples,
+            "label_counts": dict(self.label_counts),
+        }
+        if self.count:
+            stats.update({
+                "num_features": len(self.mean),
+                "feature_means": self.mean.tolist(),
+                "feature_variances": self.variance.tolist(),
+                "feature_min": self.min.tolist(),
+                "feature_max": self.max.tolist(),
+            })
+        return stats
@@ -0,0 +1,67 @@
+# dataloader/storage.py
+
+import json
+import os
+import numpy as np
+from .dataset import ArrayData
+from .utils import batched
+
+# A record file holds fixed-shape (features, label) records back to back in a
+# structured dtype; a JSON sidecar describes the layout so it can be memory-mapped
+
+def record_dtype(feature_shape, feature_dtype) -> np.dtype:
+    return np.dtype([('features', np.dtype(feature_dtype), tuple(feature_shape)), ('label', np.int64)])
+
+def sample_chunks(samples, chunk_size=4096):
+    for batch in batched(samples, chunk_size):
+        features = [np.asarray(sample.features) for sample in batch]
+        if any(f.shape != features[0].shape for f in features) or not np.issubdtype(features[0].dtype, np.number):
+            raise ValueError("record storage needs numeric features of a fixed shape")
+        yield np.stack(features), np.array([sample.label for sample in batch], dtype=np.int64)
+
+def write_records(path: str, chunks, metadata=None) -> int:
+    dtype = None
+    count = 0
+    # Per-process temp name: several processes may build the same file at once
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        with open(tmp_path, 'wb') as f:
+            for features, labels in chunks:
+                if dtype is None:
+                    dtype = record_dtype(features.shape[1:], features.dtype)
+                records = np.empty(len(labels), dtype=dtype)
+                records['features'] = features
+                records['label'] = labels
+                f.write(records.tobytes())
+                count += len(labels)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if dtype is None:
+        os.remove(tmp_path)
+        raise ValueError("no samples to write")
+    meta = {
+        'count': count,
+        'size': count * dtype.itemsize,
+        'feature_shape': list(dtype['features'].shape),
+        'feature_dtype': dtype['features'].base.str,
+        'metadata': (metadata() if callable(metadata) else metadata) or {},
+    }
+    with open(f'{tmp_path}.json', 'w') as f:
+        json.dump(meta, f)
+    # Data file first: the sidecar is what makes a file readable, so it only
+    # ever describes a data file already in place. A reader between the two
+    # swaps sees the old sidecar, whose size no longer matches, and rebuilds
+    os.replace(tmp_path, path)
+    os.replace(f'{tmp_path}.json', f'{path}.json')
+    return count
+
+def open_records(path: str, mode='r'):
+    with open(f'{path}.json') as f:
+        meta = json.load(f)
+    if 'size' in meta and os.path.getsize(path) != meta['size']:
+        raise ValueError(f"{path} does not match its sidecar")
+    records = np.memmap(path, dtype=record_dtype(meta['feature_shape'], meta['feature_dtype']),
+                        mode=mode, shape=(meta['count'],))
+    return ArrayData(records['features'], records['label']), meta['metadata']
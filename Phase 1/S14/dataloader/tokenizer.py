@@ -0,0 +1,126 @@
+# dataloader/tokenizer.py
+
+import hashlib
+import json
+import os
+from collections import Counter
+import numpy as np
+
+PAD, UNK = '<pad>', '<unk>'
+
+class Vocabulary:
+    # Token <-> int32 id mapping; id 0 is padding and id 1 stands for unknown tokens
+    def __init__(self, tokens=()):
+        self.id_to_token = [PAD, UNK] + [token for token in tokens if token not in (PAD, UNK)]
+        self.token_to_id = {token: i for i, token in enumerate(self.id_to_token)}
+
+    @classmethod
+    def build(cls, texts, min_freq=1, max_size=None):
+        # One streaming pass: only the token counts are held, not the texts
+        counts = Counter()
+        for text in texts:
+            counts.update(text.split())
+        return cls.from_counts(counts, min_freq, max_size)
+
+    @classmethod
+    def from_counts(cls, counts, min_freq=1, max_size=None):
+        ranked = sorted((token for token, count in counts.items() if count >= min_freq),
+                        key=lambda token: (-counts[token], token))
+        return cls(ranked[:max_size] if max_size is not None else ranked)
+
+    def __len__(self):
+        return len(self.id_to_token)
+
+    @property
+    def pad_id(self):
+        return 0
+
+    @property
+    def unk_id(self):
+        return 1
+
+    def encode(self, text: str) -> np.ndarray:
+        lookup = self.token_to_id.get
+        tokens = text.split()
+        return np.fromiter((lookup(token, 1) for token in tokens), dtype=np.int32, count=len(tokens))
+
+    def decode(self, ids) -> list:
+        return [self.id_to_token[i] for i in ids]
+
+    def fingerprint(self) -> str:
+        return hashlib.sha1('\n'.join(self.id_to_token).encode()).hexdigest()[:16]
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.id_to_token, f)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls(json.load(f))
+
+def pad_batch(sequences, pad_id=0, max_length=None):
+    # Packs int sequences into one (N, L) int32 array plus their int32 lengths
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int32, count=len(sequences))
+    if max_length is not None:
+        lengths = np.minimum(lengths, max_length)
+    width = int(lengths.max()) if len(lengths) else 0
+    ids = np.full((len(sequences), width), pad_id, dtype=np.int32)
+    mask = np.arange(width) < lengths[:, None]
+    if width:
+        ids[mask] = np.concatenate([np.asarray(s[:n], dtype=np.int32) for s, n in zip(sequences, lengths)])
+    return ids, lengths
+
+def pad_flat(ids, offsets, pad_id=0, max_length=None):
+    # pad_batch for sequences stored back to back: sequence i is ids[offsets[i]:offsets[i + 1]]
+    lengths = np.diff(offsets).astype(np.int32)
+    if max_length is not None:
+        lengths = np.minimum(lengths, max_length)
+    width = int(lengths.max()) if len(lengths) else 0
+    if not width:
+        return np.full((len(lengths), 0), pad_id, dtype=np.int32), lengths
+    positions = np.minimum(offsets[:-1, None] + np.arange(width), len(ids) - 1)
+    mask = np.arange(width) < lengths[:, None]
+    return np.where(mask, ids[positions], pad_id).astype(np.int32, copy=False), lengths
+
+def encode_corpus(vocabulary: Vocabulary, samples):
+    # Flat int32 ids with int64 offsets: document i is ids[offsets[i]:offsets[i + 1]]
+    pieces, offsets, labels = [], [0], []
+    for sample in samples:
+        encoded = vocabulary.encode(sample.features)
+        pieces.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+        labels.append(sample.label)
+    ids = np.concatenate(pieces) if pieces else np.empty(0, dtype=np.int32)
+    return ids, np.array(offsets, dtype=np.int64), labels
+
+def build_and_encode(samples, min_freq=1, max_size=None):
+    # Vocabulary.build and encode_corpus in one pass over the samples: tokens get
+    # provisional ids in order of first appearance, mapped to vocabulary ids once
+    # all of them are counted
+    provisional = {}
+    pieces, offsets, labels = [], [0], []
+    for sample in samples:
+        tokens = sample.features.split()
+        encoded = np.fromiter((provisional.setdefault(token, len(provisional)) for token in tokens),
+                              dtype=np.int32, count=len(tokens))
+        pieces.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+        labels.append(sample.label)
+    ids = np.concatenate(pieces) if pieces else np.empty(0, dtype=np.int32)
+    tokens = list(provisional)
+    counts = np.bincount(ids, minlength=len(tokens)).tolist()
+    vocabulary = Vocabulary.from_counts(dict(zip(tokens, counts)), min_freq, max_size)
+    lookup = vocabulary.token_to_id.get
+    remap = np.fromiter((lookup(token, vocabulary.unk_id) for token in tokens), dtype=np.int32, count=len(tokens))
+    return vocabulary, remap[ids], np.array(offsets, dtype=np.int64), labels
+
+def save_encoded(path: str, ids, offsets, labels):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, ids=ids, offsets=offsets, labels=np.asarray(labels))
+    os.replace(tmp_path, path)
+
+def load_encoded(path: str):
+    with np.load(path) as encoded:
+        return encoded['ids'], encoded['offsets'], encoded['labels']
@@ -1,35 +1,369 @@
 # dataloader/utils.py
 
 import time
-import requests
+import logging
+import hashlib
+import pickle
+import sys
+import threading
+import types
 import os
-from functools import wraps
+import numpy as np
+from collections import OrderedDict
+from functools import partial, wraps
+from itertools import islice
+from .instrumentation import Metrics, global_metrics
+
+logger = logging.getLogger('dataloader')
+
+def timing_decorator(func=None, *, stage=None):
+    # Records each call's duration under stage (default: the function name) in the
+    # metrics of the instance it is called on, when that has any, else in
+    # global_metrics; the duration is also logged at debug level
+    if func is None:
+        return lambda f: timing_decorator(f, stage=stage)
+    stage = stage or func.__name__
 
-def timer(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        print(f"Function '{func.__name__}' took {time.time() - start_time:.2f}s to complete.")
-        return result
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter_ns() - start
+            metrics = getattr(args[0], 'metrics', None) if args else None
+            (metrics if isinstance(metrics, Metrics) else global_metrics).record(stage, duration)
+            logger.debug("Function '%s' took %.2fs to complete.", func.__name__, duration / 1e9)
     return wrapper
 
-def download_file(url, dest_path):
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    
-    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-    
-    with open(dest_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+timer = timing_decorator
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+def shuffle_buffer(iterable, buffer_size, rng=None):
+    # Approximate shuffle holding at most buffer_size items: each incoming item
+    # swaps out a random resident, which is emitted in its place. rng is a NumPy
+    # Generator, e.g. samplers.epoch_rng(seed, epoch) for a reproducible order
+    rng = rng if rng is not None else np.random.default_rng()
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = int(rng.integers(buffer_size))
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+def function_fingerprint(func) -> str:
+    # Hash of the bytecode, constants and names of func and of the module-level
+    # functions it calls, so editing e.g. normalize changes the fingerprint of
+    # lambda x: normalize(augment(x)). Values it carries (closure cells, defaults,
+    # partial arguments, a bound method's self, a callable object's attributes)
+    # are hashed by content as they are now; TypeError if one cannot be
+    digest = hashlib.sha1()
+    seen = set()
+
+    def visit(obj):
+        if isinstance(obj, (bool, int, float, complex, str, bytes, type(None))):
+            digest.update(f'{type(obj).__name__}:{obj!r};'.encode())
+            return
+        if isinstance(obj, np.ndarray):
+            digest.update(repr(_key_part(obj)).encode())
+            return
+        if isinstance(obj, (type, types.ModuleType, types.BuiltinFunctionType, np.ufunc)):
+            digest.update(f'{getattr(obj, "__module__", "")}.{getattr(obj, "__qualname__", obj.__name__)};'.encode())
+            return
+        if id(obj) in seen:
+            digest.update(b'<seen>')
+            return
+        seen.add(id(obj))
+        if isinstance(obj, types.MethodType):
+            visit(obj.__func__)
+            visit(obj.__self__)
+        elif isinstance(obj, partial):
+            visit(obj.func)
+            visit(obj.args)
+            visit(obj.keywords)
+        elif isinstance(obj, types.FunctionType):
+            visit_code(obj.__code__)
+            for cell in obj.__closure__ or ():
+                visit(cell.cell_contents)
+            visit(obj.__defaults__)
+            visit(obj.__kwdefaults__)
+            visit(vars(obj))
+            for name in obj.__code__.co_names:
+                if isinstance(obj.__globals__.get(name), types.FunctionType):
+                    visit(obj.__globals__[name])
+        elif isinstance(obj, (list, tuple)):
+            digest.update(f'{type(obj).__name__}[{len(obj)}]'.encode())
+            for item in obj:
+                visit(item)
+        elif isinstance(obj, dict):
+            digest.update(f'dict[{len(obj)}]'.encode())
+            for name, value in obj.items():
+                visit(name)
+                visit(value)
+        elif isinstance(obj, (set, frozenset)):
+            digest.update(repr(sorted(function_fingerprint(item) for item in obj)).encode())
+        else:
+            digest.update(f'{type(obj).__module__}.{type(obj).__qualname__}:'.encode())
+            if hasattr(obj, '__dict__'):
+                visit(vars(obj))
+            else:
+                try:
+                    digest.update(pickle.dumps(obj, protocol=4))
+                except Exception as e:
+                    raise TypeError(f"cannot fingerprint {type(obj).__qualname__} value of {func!r}") from e
+
+    def visit_code(code):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                visit_code(const)
+            else:
+                digest.update(repr(const).encode())
+
+    visit(func)
+    return digest.hexdigest()
+
+def _key_part(value):
+    # Hashable, picklable stand-in for an argument; arrays are keyed by content
+    if isinstance(value, np.ndarray):
+        return ('ndarray', value.shape, value.dtype.str, hashlib.sha1(np.ascontiguousarray(value).data).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, tuple(_key_part(v) for v in value)
+    if isinstance(value, dict):
+        return 'dict', tuple(sorted((k, _key_part(v)) for k, v in value.items()))
+    return value
+
+def result_size(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_size(v) for v in value)
+    return sys.getsizeof(value)
+
+def cache_result(func=None, *, maxsize=128, max_bytes=None, ttl=None, disk_dir=None, disk_max_bytes=1 << 30,
+                 key=None):
+    # Memoizes func with LRU eviction by entry count (maxsize) and by result size
+    # (max_bytes, counting ndarray buffers), optional expiry after ttl seconds, and
+    # an optional pickle-per-entry disk tier in disk_dir that outlives the process.
+    # The disk tier drops expired entries and keeps to disk_max_bytes by evicting
+    # the least recently used files (by atime, which hits set; mtime is the age).
+    # key(*args, **kwargs) overrides the cache key, e.g. to add a file's mtime.
+    # The wrapper exposes cache_info() counters and cache_clear().
+    if func is None:
+        return lambda f: cache_result(f, maxsize=maxsize, max_bytes=max_bytes, ttl=ttl, disk_dir=disk_dir,
+                                      disk_max_bytes=disk_max_bytes, key=key)
+
+    # Disk entries outlive the process, so their keys cover func's code and state
+    # too; TypeError if that cannot be fingerprinted
+    prefix = f'{func.__module__}.{func.__qualname__}'
+    if disk_dir:
+        prefix = f'{prefix}:{function_fingerprint(func)}'
+    entries = OrderedDict()
+    counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'disk_hits': 0, 'disk_evictions': 0, 'bytes': 0}
+    lock = threading.Lock()
+    # Size of the disk tier as of the last scan plus writes since, and when
+    # expired entries were last swept
+    disk = {'bytes': None, 'swept': 0.0}
+
+    def make_key(args, kwargs):
+        raw = key(*args, **kwargs) if key is not None else (args, kwargs)
+        return hashlib.sha1(pickle.dumps((prefix, _key_part(raw)))).hexdigest()
+
+    def evict(cache_key):
+        _, _, size = entries.pop(cache_key)
+        counters['bytes'] -= size
+        counters['evictions'] += 1
+
+    def remember(cache_key, value, expires):
+        with lock:
+            if cache_key in entries:
+                evict(cache_key)
+                counters['evictions'] -= 1
+            size = result_size(value)
+            entries[cache_key] = (value, expires, size)
+            counters['bytes'] += size
+            while entries and (len(entries) > maxsize or (max_bytes is not None and counters['bytes'] > max_bytes)):
+                evict(next(iter(entries)))
+
+    def from_disk(cache_key, now):
+        path = os.path.join(disk_dir, f'{cache_key}.pkl')
+        try:
+            written = os.path.getmtime(path)
+            if ttl is not None and written + ttl < now:
+                os.remove(path)
+                with lock:
+                    counters['disk_evictions'] += 1
+                return None
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path, (now, written))
+            return value,
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def to_disk(cache_key, value):
+        os.makedirs(disk_dir, exist_ok=True)
+        path = os.path.join(disk_dir, f'{cache_key}.pkl')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        now = time.time()
+        with lock:
+            if disk['bytes'] is not None:
+                disk['bytes'] += size
+            # Scan the directory on the first write, when over budget, and at most
+            # once per ttl to sweep expired entries
+            due = (disk['bytes'] is None or (disk_max_bytes is not None and disk['bytes'] > disk_max_bytes)
+                   or (ttl is not None and disk['swept'] + ttl < now))
+        if due:
+            prune_disk(now)
+
+    def prune_disk(now):
+        files = []
+        with os.scandir(disk_dir) as scan:
+            for entry in scan:
+                if entry.name.endswith('.pkl'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_atime, stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, _, size, _ in files)
+        evicted = 0
+        for _, written, size, path in sorted(files):
+            if not (ttl is not None and written + ttl < now) and (disk_max_bytes is None or total <= disk_max_bytes):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with lock:
+            disk.update(bytes=total, swept=now)
+            counters['disk_evictions'] += evicted
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        cache_key = make_key(args, kwargs)
+        now = time.monotonic()
+        with lock:
+            entry = entries.get(cache_key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                entries.move_to_end(cache_key)
+                counters['hits'] += 1
+                return entry[0]
+            if entry is not None:
+                evict(cache_key)
+        expires = None if ttl is None else now + ttl
+        stored = from_disk(cache_key, time.time()) if disk_dir else None
+        if stored is not None:
+            with lock:
+                counters['disk_hits'] += 1
+            value = stored[0]
+        else:
+            with lock:
+                counters['misses'] += 1
+            value = func(*args, **kwargs)
+            if disk_dir:
+                to_disk(cache_key, value)
+        remember(cache_key, value, expires)
+        return value
+
+    def cache_info():
+        with lock:
+            return dict(counters, entries=len(entries))
+
+    def cache_clear():
+        with lock:
+            entries.clear()
+            counters.update(hits=0, misses=0, evictions=0, disk_hits=0, disk_evictions=0, bytes=0)
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    return wrapper
 
 class cached_property:
-    def __init__(self, func):
+    # Caches per instance, tagged with the instance's version_attr value: bumping
+    # that counter invalidates every cached property of the instance, and
+    # `del obj.prop` or invalidate(obj) drops one. The value is computed once
+    # under a lock even when several threads ask at the same time. Classes with
+    # __slots__ pass slot= to name the slot that holds the cache entry.
+    def __init__(self, func=None, *, version_attr='_version', slot=None):
         self.func = func
-        self.value = None
+        self.version_attr = version_attr
+        self.slot = slot
+        self._lock = threading.RLock()
+        if func is not None:
+            self.__set_name__(None, func.__name__)
+
+    def __call__(self, func):
+        # Used as @cached_property(slot=...)
+        self.func = func
+        self.__set_name__(None, func.__name__)
+        return self
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.key = self.slot or f'_cached_{name}'
 
     def __get__(self, obj, cls):
-        if self.value is None:
-            self.value = self.func(obj)
-        return self.value
+        if obj is None:
+            return self
+        version = getattr(obj, self.version_attr, None)
+        entry = self._entry(obj)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        with self._instance_lock(obj):
+            entry = self._entry(obj)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            value = self.func(obj)
+            self.__set__(obj, value, version)
+            return value
+
+    def __set__(self, obj, value, version=None):
+        if version is None:
+            version = getattr(obj, self.version_attr, None)
+        if self.slot:
+            setattr(obj, self.key, (version, value))
+        else:
+            obj.__dict__[self.key] = (version, value)
+
+    def __delete__(self, obj):
+        self.invalidate(obj)
+
+    def invalidate(self, obj):
+        if self.slot:
+            setattr(obj, self.key, None)
+        else:
+            obj.__dict__.pop(self.key, None)
+
+    def _entry(self, obj):
+        if self.slot:
+            return getattr(obj, self.key, None)
+        return obj.__dict__.get(self.key)
+
+    def _instance_lock(self, obj):
+        namespace = getattr(obj, '__dict__', None)
+        if namespace is None:
+            return self._lock
+        lock = namespace.get('_cached_property_lock')
+        if lock is None:
+            with self._lock:
+                lock = namespace.setdefault('_cached_property_lock', threading.RLock())
+        return lock
@@ -0,0 +1,116 @@
+# dataloader/workers.py
+
+import multiprocessing
+import queue
+import threading
+from collections import deque
+
+# Per-process state installed by the pool initializer, so that the preprocess
+# function (often a lambda) never has to be pickled under the fork start method
+_worker_state = {}
+
+def _init_worker(reader, preprocess_func):
+    _worker_state['reader'] = reader
+    _worker_state['preprocess_func'] = preprocess_func
+
+def process_shard(shard):
+    reader = _worker_state['reader']
+    preprocess_func = _worker_state['preprocess_func']
+    samples = shard if reader is None else (reader(*entry) for entry in shard)
+    return [preprocess_func(sample) for sample in samples if sample is not None]
+
+def read_shard(shard):
+    # process_shard keeping one result per entry, None where nothing was read
+    reader = _worker_state['reader']
+    preprocess_func = _worker_state['preprocess_func']
+    samples = (reader(*entry) for entry in shard)
+    return [None if sample is None else preprocess_func(sample) for sample in samples]
+
+def process_chunk(chunk):
+    # With a whole-chunk function (e.g. Plan.run_chunk) installed as preprocess_func
+    return _worker_state['preprocess_func'](chunk)
+
+def make_pool(num_workers, reader, preprocess_func):
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    return context.Pool(num_workers, initializer=_init_worker, initargs=(reader, preprocess_func))
+
+def parallel_map(pool, func, tasks, ordered=True, max_in_flight=2):
+    if ordered:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        return
+
+    results = queue.Queue()
+    in_flight = 0
+
+    def take():
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    for task in tasks:
+        pool.apply_async(func, (task,), callback=results.put, error_callback=results.put)
+        in_flight += 1
+        if in_flight >= max_in_flight:
+            in_flight -= 1
+            yield take()
+    for _ in range(in_flight):
+        yield take()
+
+class Prefetcher:
+    # Iterates on a background thread, keeping up to depth items ready in a queue;
+    # errors are raised on the consuming side. close() stops the thread early
+    _DONE = object()
+
+    def __init__(self, iterable, depth=2):
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopping = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._fill, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _fill(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+            self._put((self._DONE, None))
+        except BaseException as e:
+            self._put((None, e))
+
+    def _put(self, entry):
+        # Waits for room in the queue, but gives up once close() is called
+        while not self._stopping.is_set():
+            try:
+                self._queue.put(entry, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item, error = self._queue.get()
+        if error is not None or item is self._DONE:
+            self._finished = True
+            self._thread.join()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
+        self._finished = True
@@ -3,6 +3,7 @@
 import sys
 import argparse
 from dataloader import DataLoader
+from dataloader.dataset import DataSample
 from dataloader.preprocessors import normalize, augment, tokenize
 
 def main():
@@ -12,9 +13,10 @@ def main():
     parser.add_argument("--shuffle", action="store_true", help="Shuffle the data")
     args = parser.parse_args()
 
-    # Initialize DataLoader
+    # Initialize DataLoader: decoding and normalization happen once at load time,
+    # augmentation afresh on every batch of every epoch
     data_loader = DataLoader(dataset_name=args.dataset, batch_size=args.batch_size, 
-                             shuffle=args.shuffle, preprocess_func=lambda x: normalize(augment(x)))
+                             shuffle=args.shuffle, preprocess_func=normalize, augment_func=augment)
 
     # Iterate over data
     with data_loader.batch_context():
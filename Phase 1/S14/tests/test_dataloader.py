@@ -3,11 +3,46 @@
 import unittest
 import os
 import sys
+import tempfile
+import numpy as np
+from contextlib import contextmanager
 sys.path.append('..')  # Adjust the path as needed
 from dataloader import DataLoader
 from dataloader.utils import timer
 from dataloader.preprocessors import default_preprocess
+from dataloader.dataset import DataSample
 from collections import namedtuple
+from unittest import mock
+
+@contextmanager
+def local_dataset(files):
+    # Lay out datasets/<path> files in a scratch directory and run from there
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        for path, content in files.items():
+            full_path = os.path.join(tmp, 'datasets', path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+                f.write(content)
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+def make_png(value, size=(8, 8)):
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (value, value, value)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def make_csv(num_rows, num_features=3):
+    return ''.join(','.join([str(float(i))] * num_features + [str(i % 2)]) + '\n' for i in range(num_rows))
+
+# Call log for functions with cached results: values a function captures are
+# part of its fingerprint, module globals are not
+calls = []
 
 class TestDataLoader(unittest.TestCase):
 
@@ -136,5 +171,920 @@ class TestDataLoader(unittest.TestCase):
         except Exception as e:
             self.fail(f"main() raised Exception unexpectedly: {e}")
 
+    def test_streaming_mode(self):
+        """Test Case 16: Lazy Streaming Mode"""
+        with local_dataset({'stream.csv': make_csv(25)}):
+            data_loader = DataLoader(dataset_name='stream.csv', batch_size=10, shuffle=True,
+                                     streaming=True, shuffle_buffer_size=4)
+            self.assertEqual(data_loader.data, [])
+            batches = list(data_loader)
+            self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+            values = sorted(value for batch in batches for value in batch.features[:, 0])
+            self.assertEqual(values, [float(i) for i in range(25)])
+
+    def test_columnar_batches(self):
+        """Test Case 17: Columnar NumPy Batches"""
+        with local_dataset({'columns.csv': make_csv(12)}):
+            data_loader = DataLoader(dataset_name='columns.csv', batch_size=5, shuffle=False, streaming=True,
+                                     vectorized_csv=False, reuse_buffers=True)
+            batches = [(batch.features.copy(), batch.labels.copy(), batch.features) for batch in data_loader]
+            features, labels, buffer = batches[0]
+            self.assertEqual(features.shape, (5, 3))
+            self.assertEqual(features.dtype, np.float32)
+            self.assertEqual(labels.tolist(), [0, 1, 0, 1, 0])
+            self.assertEqual(len(batches[-1][1]), 2)
+            self.assertTrue(np.shares_memory(buffer, batches[1][2]))
+
+            raw_loader = DataLoader(dataset_name='columns.csv', batch_size=5, collate_fn=None)
+            self.assertIsInstance(next(iter(raw_loader)), list)
+
+    def test_worker_pool(self):
+        """Test Case 18: Multi-Process Workers"""
+        files = {f'corpus/{label}/doc{i}.txt': f'doc {label}{i}' for label in 'ab' for i in range(6)}
+        with local_dataset(files):
+            serial = DataLoader(dataset_name='corpus', batch_size=4, shuffle=False,
+                                preprocess_func=lambda x: x._replace(features=x.features.upper()))
+            parallel = DataLoader(dataset_name='corpus', batch_size=4, shuffle=False, num_workers=2,
+                                  preprocess_func=lambda x: x._replace(features=x.features.upper()))
+            self.assertEqual(parallel.data, serial.data)
+            self.assertTrue(all(sample.features.isupper() for sample in parallel.data))
+
+            unordered = DataLoader(dataset_name='corpus', batch_size=4, shuffle=False, num_workers=2,
+                                   ordered=False, streaming=True)
+            samples = [sample for batch in unordered for sample in batch]
+            self.assertEqual(sorted(samples), sorted(s._replace(features=s.features.lower()) for s in serial.data))
+
+    def test_vectorized_csv(self):
+        """Test Case 19: Vectorized CSV Ingestion"""
+        cars = 'Car;MPG;Cylinders;Origin\nChevelle;18.0;8;US\nCorolla;33.;4;Japan\nRabbit;29.0;4;Europe\nNova;17.5;6;US\n'
+        with local_dataset({'cars.csv': cars}):
+            data_loader = DataLoader(dataset_name='cars.csv', batch_size=3, shuffle=False, delimiter=';',
+                                     header=True, feature_columns=['MPG', 'Cylinders'], csv_chunk_rows=2)
+            self.assertEqual(data_loader.feature_names, ['MPG', 'Cylinders'])
+            self.assertEqual(data_loader.data.features.dtype, np.float32)
+            self.assertEqual(data_loader.data.features[:, 1].tolist(), [8, 4, 4, 6])
+            self.assertEqual([data_loader.label_names[i] for i in data_loader.data.labels], ['US', 'Japan', 'Europe', 'US'])
+
+            streamed = DataLoader(dataset_name='cars.csv', batch_size=3, shuffle=False, streaming=True, delimiter=';',
+                                  header=True, feature_columns=['MPG', 'Cylinders'], csv_chunk_rows=2)
+            batches = list(streamed)
+            self.assertEqual([len(batch) for batch in batches], [3, 1])
+            self.assertEqual(batches[0].features[:, 0].tolist(), [18.0, 33.0, 29.0])
+
+            # Without feature_columns the non-numeric Car column is skipped
+            inferred = DataLoader(dataset_name='cars.csv', shuffle=False, delimiter=';', header=True)
+            self.assertEqual(inferred.feature_names, ['MPG', 'Cylinders'])
+            self.assertEqual(len(inferred.data), 4)
+
+        with local_dataset({'broken.csv': make_csv(4) + 'x,1.0,1.0,0\n'}):
+            with self.assertRaises(ValueError):
+                DataLoader(dataset_name='broken.csv', shuffle=False, csv_chunk_rows=2)
+
+        # The first chunk settles integer labels vs. one table of category codes
+        with local_dataset({'ints.csv': '1.0,0\n2.0,1\n3.0,cat\n4.0,dog\n',
+                            'names.csv': '1.0,cat\n2.0,dog\n3.0,0\n4.0,cat\n'}):
+            with self.assertRaises(ValueError):
+                DataLoader(dataset_name='ints.csv', shuffle=False, csv_chunk_rows=2)
+            named = DataLoader(dataset_name='names.csv', shuffle=False, csv_chunk_rows=2)
+            self.assertEqual([named.label_names[i] for i in named.data.labels], ['cat', 'dog', '0', 'cat'])
+
+    def test_dataset_cache(self):
+        """Test Case 20: Binary Dataset Cache"""
+        calls.clear()
+        def preprocess(sample):
+            calls.append(sample.label)
+            return sample._replace(features=sample.features * 2)
+
+        with local_dataset({'cached.csv': make_csv(6)}):
+            first = DataLoader(dataset_name='cached.csv', shuffle=False, cache=True, preprocess_func=preprocess)
+            second = DataLoader(dataset_name='cached.csv', shuffle=False, cache=True, preprocess_func=preprocess)
+            self.assertEqual(len(calls), 6)
+            self.assertIsInstance(second.data.features, np.memmap)
+            np.testing.assert_array_equal(second.data.features, first.data.features)
+            self.assertEqual(second.data.features[5, 0], 10.0)
+
+            with open('datasets/cached.csv', 'a') as f:
+                f.write('6.0,6.0,6.0,0\n')
+            third = DataLoader(dataset_name='cached.csv', shuffle=False, cache=True, preprocess_func=preprocess)
+            self.assertEqual(len(third.data), 7)
+
+    def test_memmap_backend(self):
+        """Test Case 21: Memory-Mapped Backend"""
+        with local_dataset({'mapped.csv': make_csv(10)}):
+            data_loader = DataLoader(dataset_name='mapped.csv', batch_size=4, shuffle=False, backend='memmap')
+            self.assertTrue(os.path.exists('datasets/mapped.csv.records'))
+            batch = next(iter(data_loader))
+            self.assertTrue(np.shares_memory(batch.features, data_loader.data.features))
+            self.assertEqual(batch.labels.tolist(), [0, 1, 0, 1])
+
+            shuffled = DataLoader(dataset_name='mapped.csv', batch_size=4, shuffle=True, backend='memmap')
+            values = sorted(value for batch in shuffled for value in batch.features[:, 0])
+            self.assertEqual(values, [float(i) for i in range(10)])
+            self.assertEqual(shuffled.data.features[:, 0].tolist(), [float(i) for i in range(10)])
+
+            # A reader between the data and sidecar swaps of a rewrite rebuilds
+            # rather than mapping the new data with the old layout
+            from dataloader.storage import open_records
+            with open('datasets/mapped.csv.records.json') as f:
+                old_sidecar = f.read()
+            with open('datasets/mapped.csv', 'w') as f:
+                f.write(make_csv(12))
+            DataLoader(dataset_name='mapped.csv', shuffle=False, backend='memmap')
+            with open('datasets/mapped.csv.records.json', 'w') as f:
+                f.write(old_sidecar)
+            with self.assertRaises(ValueError):
+                open_records('datasets/mapped.csv.records')
+            rebuilt = DataLoader(dataset_name='mapped.csv', shuffle=False, backend='memmap')
+            self.assertEqual(rebuilt.data.features[:, 0].tolist(), [float(i) for i in range(12)])
+
+    def test_samplers(self):
+        """Test Case 22: Index Samplers"""
+        from dataloader.samplers import DistributedSampler, StratifiedSampler
+
+        with local_dataset({'sampled.csv': make_csv(20)}):
+            def epoch_labels(data_loader):
+                return [value for batch in data_loader for value in batch.features[:, 0]]
+
+            first = DataLoader(dataset_name='sampled.csv', batch_size=4, seed=7)
+            second = DataLoader(dataset_name='sampled.csv', batch_size=4, seed=7)
+            self.assertEqual(epoch_labels(first), epoch_labels(second))
+            self.assertNotEqual(epoch_labels(first), epoch_labels(first))
+
+            shards = [epoch_labels(DataLoader(dataset_name='sampled.csv', batch_size=4,
+                                              sampler=DistributedSampler(3, rank, seed=1)))
+                      for rank in range(3)]
+            self.assertEqual(sorted(sum(shards, [])), [float(i) for i in range(20)])
+
+            stratified = DataLoader(dataset_name='sampled.csv', batch_size=4, sampler=StratifiedSampler(seed=3))
+            for batch in stratified:
+                self.assertEqual(sorted(batch.labels.tolist()), [0, 0, 1, 1])
+
+        # Streaming shuffles follow seed= and the epoch too
+        files = {'sampled.csv': make_csv(20), **{f'notes/a/{i}.txt': str(i) for i in range(20)}}
+        with local_dataset(files):
+            for name, options in (('sampled.csv', {'csv_chunk_rows': 8}), ('notes', {'shuffle_buffer_size': 8})):
+                def epoch_order(data_loader):
+                    return [str(batch) for batch in data_loader]
+
+                first = DataLoader(dataset_name=name, batch_size=4, streaming=True, seed=1, **options)
+                second = DataLoader(dataset_name=name, batch_size=4, streaming=True, seed=1, **options)
+                self.assertEqual(epoch_order(first), epoch_order(second))
+                self.assertNotEqual(epoch_order(first), epoch_order(first))
+
+    def test_parallel_download(self):
+        """Test Case 23: Parallel Resumable Downloads"""
+        import hashlib
+        import io
+        import json
+        import tarfile
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from dataloader.download import DownloadManager, DownloadSpec, extract
+
+        payload = os.urandom(100_000)
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            info = tarfile.TarInfo('0/img.txt')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'hello'))
+        files = {'/data.bin': payload, '/data.tar.gz': archive.getvalue(), '/no-head.bin': b'whole'}
+        requested = []
+
+        class RangeHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                if self.path == '/no-head.bin':
+                    self.send_response(405)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(files[self.path])))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+
+            def do_GET(self):
+                body = files[self.path]
+                if 'Range' not in self.headers:
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                start, end = map(int, self.headers['Range'].split('=')[1].split('-'))
+                requested.append((self.path, start))
+                self.send_response(206)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+                self.wfile.write(body[start:end + 1])
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                # Pretend an earlier run finished the first 16 KiB range and was interrupted
+                with open(os.path.join(tmp, 'data.bin.part'), 'wb') as f:
+                    f.write(payload[:16384])
+                    f.truncate(len(payload))
+                with open(os.path.join(tmp, 'data.bin.part.json'), 'w') as f:
+                    json.dump({'url': url + '/data.bin', 'size': len(payload), 'done': [[0, 16383]]}, f)
+
+                manager = DownloadManager(tmp, part_size=16384)
+                checksum = 'sha256:' + hashlib.sha256(payload).hexdigest()
+                data_path, archive_path = manager.download([DownloadSpec(url + '/data.bin', checksum=checksum),
+                                                            DownloadSpec(url + '/data.tar.gz')])
+                with open(data_path, 'rb') as f:
+                    self.assertEqual(f.read(), payload)
+                self.assertNotIn(('/data.bin', 0), requested)
+                self.assertEqual(len([r for r in requested if r[0] == '/data.bin']), 6)
+                self.assertFalse(os.path.exists(data_path + '.part.json'))
+
+                extract(archive_path, tmp)
+                with open(os.path.join(tmp, '0', 'img.txt')) as f:
+                    self.assertEqual(f.read(), 'hello')
+
+                with self.assertRaises(ValueError):
+                    manager.download([DownloadSpec(url + '/data.bin', 'copy.bin', checksum='md5:0')])
+
+                whole_path, = manager.download([DownloadSpec(url + '/no-head.bin')])
+                with open(whole_path, 'rb') as f:
+                    self.assertEqual(f.read(), b'whole')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with local_dataset({}):
+            with self.assertRaises(ValueError):
+                DataLoader(dataset_name='missing.csv')
+            self.assertFalse(os.path.exists('datasets/missing.csv.partial'))
+            self.assertFalse(os.path.exists('datasets/missing.csv'))
+
+    def test_batch_transforms(self):
+        """Test Case 24: Batched Transform Pipeline"""
+        from dataloader.collate import Batch
+        from dataloader.preprocessors import normalize, Pipeline
+
+        per_sample = []
+        def offset(sample):
+            per_sample.append(sample.label)
+            return sample._replace(features=sample.features + 1)
+
+        with local_dataset({'pixels.csv': make_csv(6)}):
+            data_loader = DataLoader(dataset_name='pixels.csv', batch_size=4, shuffle=False, backend='memmap',
+                                     transforms=[normalize, offset])
+            batch = next(iter(data_loader))
+            np.testing.assert_allclose(batch.features[:, 0], np.arange(4) / 255.0 + 1, rtol=1e-6)
+            self.assertEqual(batch.features.dtype, np.float32)
+            self.assertEqual(len(per_sample), 4)
+            self.assertEqual(data_loader.data.features[1, 0], 1.0)
+
+        pipeline = Pipeline(normalize, reuse_buffers=True)
+        images = Batch(np.full((2, 4, 4, 3), 255, dtype=np.uint8), np.zeros(2, dtype=np.int64))
+        first, second = pipeline.apply_batch(images), pipeline.apply_batch(images)
+        self.assertTrue(np.all(second.features == 1.0))
+        self.assertTrue(np.shares_memory(first.features, second.features))
+
+    def test_data_statistics(self):
+        """Test Case 25: Single-Pass Statistics"""
+        from dataloader.stats import RunningStats
+
+        with local_dataset({'stats.csv': make_csv(10)}):
+            values = np.arange(10, dtype=np.float64)
+            for streaming in (False, True):
+                stats = DataLoader(dataset_name='stats.csv', streaming=streaming, batch_size=3,
+                                   statistics_chunk_size=4).data_statistics
+                self.assertEqual(stats['num_samples'], 10)
+                self.assertEqual(stats['num_features'], 3)
+                np.testing.assert_allclose(stats['feature_means'], [values.mean()] * 3)
+                np.testing.assert_allclose(stats['feature_variances'], [values.var()] * 3)
+                self.assertEqual(stats['feature_max'], [9.0] * 3)
+                self.assertEqual(stats['label_counts'], {0: 5, 1: 5})
+
+        rng = np.random.default_rng(0)
+        x = rng.normal(1e6, 1.0, size=(1000, 2))
+        left, right = RunningStats().update(x[:300]), RunningStats().update(x[300:])
+        merged = left.merge(right)
+        np.testing.assert_allclose(merged.mean, x.mean(axis=0))
+        np.testing.assert_allclose(merged.variance, x.var(axis=0), rtol=1e-6)
+
+    def test_cached_property(self):
+        """Test Case 26: Per-Instance Cached Properties"""
+        import threading
+        from dataloader.utils import cached_property
+
+        with local_dataset({'a.csv': make_csv(4), 'b.csv': make_csv(6)}):
+            first, second = DataLoader(dataset_name='a.csv'), DataLoader(dataset_name='b.csv')
+            self.assertEqual(first.data_statistics['num_samples'], 4)
+            self.assertEqual(second.data_statistics['num_samples'], 6)
+            self.assertIs(first.data_statistics, first.data_statistics)
+            first.filter_data(lambda x: x.label == 0)
+            self.assertEqual(first.data_statistics['num_samples'], 2)
+
+        class Slotted:
+            __slots__ = ('_version', '_area_cache')
+            calls = []
+
+            def __init__(self):
+                self._version = 0
+
+            @cached_property(slot='_area_cache')
+            def area(self):
+                self.calls.append(threading.get_ident())
+                return 42
+
+        shape = Slotted()
+        threads = [threading.Thread(target=lambda: shape.area) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(Slotted.calls), 1)
+        del shape.area
+        self.assertEqual(shape.area, 42)
+        self.assertEqual(len(Slotted.calls), 2)
+
+    def test_cache_result(self):
+        """Test Case 27: Result Memoization"""
+        from dataloader.utils import cache_result
+
+        calls = []
+        @cache_result(maxsize=2, max_bytes=64)
+        def zeros(n):
+            calls.append(n)
+            return np.zeros(n, dtype=np.uint8)
+
+        zeros(8), zeros(8), zeros(16), zeros(32)
+        self.assertEqual(calls, [8, 16, 32])
+        info = zeros.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['entries']), (1, 3, 2))
+        self.assertEqual(info['bytes'], 48)
+        zeros(40)
+        self.assertEqual(zeros.cache_info()['entries'], 1)
+
+        ttl_calls = []
+        expiring = cache_result(ttl=0)(lambda x: ttl_calls.append(x) or x)
+        expiring(1), expiring(1)
+        self.assertEqual(ttl_calls, [1, 1])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bounded = cache_result(disk_dir=os.path.join(tmp, 'bounded'), disk_max_bytes=1000)(
+                lambda n: np.zeros(n, dtype=np.uint8))
+            for n in (400, 401, 402):
+                bounded(n)
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'bounded'))), 1)
+            self.assertEqual(bounded.cache_info()['disk_evictions'], 2)
+
+            stale = cache_result(ttl=0, disk_dir=os.path.join(tmp, 'stale'))(lambda n: n)
+            for n in range(5):
+                stale(n)
+            self.assertLessEqual(len(os.listdir(os.path.join(tmp, 'stale'))), 1)
+
+        files = {f'MNIST/{label}/img{i}.png': make_png(label * 50) for label in range(2) for i in range(3)}
+        with local_dataset(files):
+            options = {'disk_dir': 'datasets/.decoded'}
+            first = DataLoader(dataset_name='MNIST', shuffle=False, decode_cache=options)
+            self.assertEqual(first.image_reader.cache_info()['misses'], 6)
+            second = DataLoader(dataset_name='MNIST', shuffle=False, decode_cache=options)
+            self.assertEqual(second.image_reader.cache_info()['disk_hits'], 6)
+            np.testing.assert_array_equal(second.data[3].features, first.data[3].features)
+
+    def test_instrumentation(self):
+        """Test Case 28: Pipeline Stage Instrumentation"""
+        import json
+        from dataloader.instrumentation import Histogram
+
+        with local_dataset({'profiled.csv': make_csv(20)}):
+            data_loader = DataLoader(dataset_name='profiled.csv', batch_size=5, profile=True, streaming=True)
+            for batch in data_loader:
+                pass
+            summary = json.loads(data_loader.metrics.to_json())
+            for stage in ('load_data', 'read', 'decode', 'collate', 'batch', 'wait_for_consumer'):
+                self.assertIn(stage, summary)
+            self.assertEqual(summary['batch']['count'], 4)
+            self.assertEqual(summary['batch']['items'], 20)
+            self.assertEqual(summary['wait_for_consumer']['count'], 4)
+
+            quiet = DataLoader(dataset_name='profiled.csv', batch_size=5)
+            list(quiet)
+            self.assertEqual(quiet.metrics.summary(), {})
+
+        with local_dataset({f'MNIST/{label}/{i}.png': make_png(label) for label in range(2) for i in range(2)}):
+            images = DataLoader(dataset_name='MNIST', batch_size=2, profile=True)
+            list(images)
+            self.assertIn('decode', images.metrics.summary())
+
+        histogram = Histogram()
+        for duration in range(1, 1001):
+            histogram.add(duration * 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 500_000, delta=50_000)
+        self.assertAlmostEqual(histogram.percentile(99), 990_000, delta=99_000)
+
+    def test_fast_image_decode(self):
+        """Test Case 29: Reduced-Resolution Decode and Batch Geometry"""
+        import io
+        from PIL import Image
+        from dataloader.images import rotate_batch, resize_batch, center_crop_batch, random_crop_batch
+        from dataloader.collate import Batch
+        from dataloader.preprocessors import Pipeline, augment, center_crop, random_crop, resize
+
+        jpeg = io.BytesIO()
+        Image.new('RGB', (256, 128), (200, 10, 10)).save(jpeg, format='JPEG')
+        files = {f'CIFAR-10/{label}/img{label}.jpg': jpeg.getvalue() for label in range(3)}
+        with local_dataset(files):
+            data_loader = DataLoader(dataset_name='CIFAR-10', shuffle=False, image_size=(32, 16), image_mode='L')
+            batch = next(iter(data_loader))
+            self.assertEqual(batch.features.shape, (3, 16, 32))
+            self.assertEqual(batch.features.dtype, np.uint8)
+
+        images = np.arange(2 * 4 * 4 * 3).reshape(2, 4, 4, 3)
+        np.testing.assert_array_equal(rotate_batch(images, 90), np.rot90(images, k=1, axes=(1, 2)))
+        self.assertEqual(resize_batch(images, (2, 2)).shape, (2, 2, 2, 3))
+        np.testing.assert_array_equal(center_crop_batch(images, (2, 2)), images[:, 1:3, 1:3])
+        crops = random_crop_batch(images, (3, 3), np.random.default_rng(0))
+        self.assertEqual(crops.shape, (2, 3, 3, 3))
+
+        batch = Batch(images.astype(np.float32), np.array([0, 1]))
+        np.testing.assert_array_equal(Pipeline(center_crop((2, 2))).apply_batch(batch).features, images[:, 1:3, 1:3])
+        self.assertEqual(Pipeline(resize((2, 2))).apply_batch(batch).features.shape, (2, 2, 2, 3))
+        cropped = Pipeline(random_crop((3, 3))).apply_batch(batch, np.random.default_rng(0)).features
+        np.testing.assert_array_equal(cropped, crops)
+        self.assertEqual(random_crop((3, 3))(DataSample(images[0], 0)).features.shape, (3, 3, 3))
+
+        photo = np.random.default_rng(0).integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+        pil_rotated = np.array(Image.fromarray(photo, 'RGB').rotate(10))
+        augmented = augment(DataSample(features=photo, label=0)).features
+        self.assertLessEqual(np.mean(np.any(pil_rotated != augmented, axis=-1)), 0.001)
+
+    def test_file_index(self):
+        """Test Case 30: Persistent File Index"""
+        from dataloader.file_index import FileIndex
+
+        files = {f'docs/{label}/{sub}/doc{i}.txt': f'{label} {i}' for label in 'ab' for sub in 'xy' for i in range(3)}
+        with local_dataset(files):
+            data_loader = DataLoader(dataset_name='docs', shuffle=False, file_index=True)
+            self.assertEqual(len(data_loader.data), 12)
+            self.assertTrue(os.path.exists('datasets/docs.index.npz'))
+            self.assertEqual(sorted({sample.label for sample in data_loader.data}), ['x', 'y'])
+
+            index = FileIndex.load('datasets/docs')
+            self.assertFalse(index.update())
+            os.remove('datasets/docs/a/x/doc0.txt')
+            os.makedirs('datasets/docs/c/z')
+            with open('datasets/docs/c/z/new.txt', 'w') as f:
+                f.write('new')
+            self.assertTrue(index.update())
+            paths = sorted(os.path.relpath(path, 'datasets/docs') for path, _, _, _ in index.entries())
+            self.assertEqual(len(paths), 12)
+            self.assertIn(os.path.join('c', 'z', 'new.txt'), paths)
+            self.assertNotIn(os.path.join('a', 'x', 'doc0.txt'), paths)
+            self.assertEqual(sorted(paths), sorted(os.path.relpath(path, 'datasets/docs')
+                                                   for path, _, _, _ in FileIndex.build('datasets/docs').entries()))
+
+    def test_sharded_corpus(self):
+        """Test Case 31: Packed Text Shards"""
+        from dataloader.shards import pack_text_corpus, ShardedCorpus
+
+        files = {f'raw/{label}/doc{i}.txt': f'{label} document {i} ' * (i + 1) for label in ('neg', 'pos') for i in range(5)}
+        with local_dataset(files):
+            self.assertEqual(pack_text_corpus('datasets/raw', 'datasets/packed', shard_bytes=100), 10)
+            corpus = ShardedCorpus('datasets/packed')
+            self.assertGreater(len([f for f in os.listdir('datasets/packed') if f.startswith('shard-')]), 1)
+            self.assertEqual(corpus.sample(3), DataSample(features='neg document 3 ' * 4, label='neg'))
+            corpus.close()
+
+            packed = DataLoader(dataset_name='packed', shuffle=False, collate_fn=None)
+            raw = DataLoader(dataset_name='raw', shuffle=False, collate_fn=None)
+            self.assertEqual(sorted(packed.data), sorted(raw.data))
+            with mock.patch.object(ShardedCorpus, 'close', autospec=True, side_effect=ShardedCorpus.close) as close:
+                parallel = DataLoader(dataset_name='packed', shuffle=False, num_workers=2, collate_fn=None)
+            self.assertEqual(parallel.data, packed.data)
+            close.assert_called_once()
+            self.assertEqual(close.call_args.args[0]._maps, {})
+
+        with local_dataset({'raw/a/0.txt': '', 'raw/a/1.txt': 'one', 'raw/b/2.txt': ''}):
+            self.assertEqual(pack_text_corpus('datasets/raw', 'datasets/packed'), 3)
+            corpus = ShardedCorpus('datasets/packed')
+            self.assertEqual([corpus.sample(i) for i in range(3)],
+                             [DataSample('', 'a'), DataSample('one', 'a'), DataSample('', 'b')])
+            corpus.close()
+
+    def test_tokenizer(self):
+        """Test Case 32: Vocabulary Tokenizer"""
+        from dataloader.tokenizer import Vocabulary, build_and_encode, pad_batch
+
+        vocabulary = Vocabulary.build(['the cat sat', 'the dog sat', 'a bird'], min_freq=2)
+        self.assertEqual(vocabulary.id_to_token, ['<pad>', '<unk>', 'sat', 'the'])
+        np.testing.assert_array_equal(vocabulary.encode('the bird sat'), [3, 1, 2])
+        built, ids, offsets, _ = build_and_encode([DataSample(text, 0) for text in ['the cat sat', 'the dog sat', 'a bird']],
+                                                  min_freq=2)
+        self.assertEqual(built.id_to_token, vocabulary.id_to_token)
+        np.testing.assert_array_equal(ids, [3, 1, 2, 3, 1, 2, 1, 1])
+        np.testing.assert_array_equal(offsets, [0, 3, 6, 8])
+        ids, lengths = pad_batch([np.array([4, 5, 6]), np.array([7])])
+        np.testing.assert_array_equal(ids, [[4, 5, 6], [7, 0, 0]])
+        np.testing.assert_array_equal(lengths, [3, 1])
+
+        files = {f'reviews/{label}/r{i}.txt': ' '.join(['good'] * (i + 1)) + f' {label}' for label in ('neg', 'pos')
+                 for i in range(3)}
+        with local_dataset(files):
+            data_loader = DataLoader(dataset_name='reviews', batch_size=4, shuffle=False, tokenizer=True)
+            self.assertEqual(data_loader.data[0].features.dtype, np.int32)
+            batch = next(iter(data_loader))
+            self.assertEqual(batch.features.shape, (4, batch.lengths.max()))
+            self.assertTrue(set(batch.lengths.tolist()) <= {2, 3, 4})
+            self.assertTrue(set(batch.labels.tolist()) <= {'neg', 'pos'})
+            self.assertTrue((batch.features[:, 0] == data_loader.vocabulary.token_to_id['good']).all())
+
+            calls.clear()
+            repeat = DataLoader(dataset_name='reviews', batch_size=4, shuffle=False, tokenizer=True,
+                                collate_fn=None, preprocess_func=lambda x: calls.append(x) or x)
+            self.assertEqual(len(calls), 6)
+            again = DataLoader(dataset_name='reviews', batch_size=4, shuffle=False, tokenizer=True,
+                               collate_fn=None, preprocess_func=lambda x: calls.append(x) or x)
+            self.assertEqual(len(calls), 6)
+            np.testing.assert_array_equal(again.data[5].features, repeat.data[5].features)
+            self.assertEqual(again.vocabulary.id_to_token, repeat.vocabulary.id_to_token)
+
+            streamed = DataLoader(dataset_name='reviews', batch_size=4, shuffle=False, tokenizer=True, streaming=True)
+            self.assertEqual([len(batch) for batch in streamed], [4, 2])
+
+    def test_compact_samples(self):
+        """Test Case 33: Struct-of-Arrays Samples"""
+        from dataloader.dataset import ArrayData
+        from dataloader.preprocessors import batch_transform, normalize, tokenize
+
+        with local_dataset({'rows.csv': make_csv(10), 'notes/a/n.txt': 'some text'}):
+            data_loader = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, vectorized_csv=False)
+            self.assertIsInstance(data_loader.data, ArrayData)
+            self.assertEqual(data_loader.data.features.shape, (10, 3))
+            self.assertIsInstance(data_loader.data[3], DataSample)
+
+            data_loader.filter_data(lambda x: x.label == 0)
+            self.assertEqual(data_loader.materialize().data.labels.tolist(), [0] * 5)
+            @batch_transform(lambda features, labels: features[:, 0] < 6)
+            def small(sample):
+                return sample.features[0] < 6
+
+            data_loader.filter_data(small)
+            self.assertEqual(len(data_loader.materialize().data), 3)
+            data_loader.filter_data(np.array([True, False, True]))
+            self.assertEqual(data_loader.data.features[:, 0].tolist(), [0, 4])
+            data_loader.apply_transformation(normalize)
+            self.assertEqual(data_loader.materialize().data.features.dtype, np.float32)
+            self.assertAlmostEqual(float(data_loader.data.features[1, 0]), 4 / 255, places=6)
+            self.assertEqual(len(next(iter(data_loader))), 2)
+
+            text_loader = DataLoader(dataset_name='notes', batch_size=4)
+            self.assertEqual(text_loader.data, [DataSample(features='some text', label='a')])
+
+        # Tokens that look like numbers stay strings
+        with local_dataset({'dates/a/d.txt': '2024 10 5'}):
+            tokenized = DataLoader(dataset_name='dates', preprocess_func=tokenize)
+            self.assertEqual(tokenized.data, [DataSample(features=['2024', '10', '5'], label='a')])
+
+        ragged = ArrayData.concatenate([
+            ArrayData.from_samples([DataSample(np.array([1, 2]), 0), DataSample(np.array([3, 4]), 1)]),
+            ArrayData.from_samples([DataSample(np.array([5]), 2), DataSample(np.array([6, 7, 8]), 3)]),
+        ])
+        self.assertEqual(ragged.offsets.tolist(), [0, 2, 4, 5, 8])
+        self.assertEqual(ragged[-1].features.tolist(), [6, 7, 8])
+        picked = ragged[np.array([3, 0])]
+        self.assertEqual(picked.features.tolist(), [6, 7, 8, 1, 2])
+        self.assertEqual(picked.offsets.tolist(), [0, 3, 5])
+        self.assertEqual([sample.features.tolist() for sample in ragged[1:3]], [[3, 4], [5]])
+        self.assertEqual(ragged[::2].labels.tolist(), [0, 2])
+
+    def test_lazy_plan(self):
+        """Test Case 34: Lazy Fused Transformation Plan"""
+        calls.clear()
+
+        def double(sample):
+            calls.append('double')
+            return sample._replace(features=sample.features * 2)
+
+        def even(sample):
+            calls.append('even')
+            return sample.label % 2 == 0
+
+        with local_dataset({'rows.csv': make_csv(9)}):
+            data_loader = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, plan_chunk_size=4)
+            original = data_loader.data
+            data_loader.apply_transformation(double)
+            data_loader.filter_data(even)
+            self.assertIs(data_loader.data, original)
+            self.assertEqual(calls, [])
+            key = data_loader.plan_key()
+
+            batches = list(data_loader)
+            self.assertEqual(calls, (['double'] * 4 + ['even'] * 4) * 2 + ['double', 'even'])
+            self.assertEqual(data_loader.data.features[:, 0].tolist(), [0, 4, 8, 12, 16])
+            self.assertEqual([len(batch) for batch in batches], [4, 1])
+            self.assertEqual(data_loader.data_statistics['num_samples'], 5)
+
+            parallel = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, plan_workers=2,
+                                  plan_chunk_size=4)
+            parallel.apply_transformation(lambda x: x._replace(features=x.features * 2))
+            parallel.filter_data(lambda x: x.label % 2 == 0)
+            np.testing.assert_array_equal(parallel.materialize().data.features, data_loader.data.features)
+            self.assertNotEqual(parallel.plan_key(), key)
+
+            cached = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, cache=True)
+            cached.apply_transformation(double)
+            cached.filter_data(even)
+            self.assertEqual(cached.plan_key(), key)
+            cached.materialize()
+            calls.clear()
+            again = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, cache=True)
+            again.apply_transformation(double)
+            again.filter_data(even)
+            self.assertIsInstance(again.materialize().data.features, np.memmap)
+            self.assertEqual(calls, [])
+            np.testing.assert_array_equal(again.data.features, data_loader.data.features)
+
+            streamed = DataLoader(dataset_name='rows.csv', batch_size=4, streaming=True, shuffle=False)
+            streamed.filter_data(even)
+            self.assertEqual([len(batch) for batch in streamed], [4, 1])
+
+    def test_feature_preprocessors(self):
+        """Test Case 35: Feature Matrix Preprocessors"""
+        from dataloader import normalize_features, select_features
+        from dataloader.collate import Batch
+        from dataloader.preprocessors import Pipeline
+        from dataloader.stats import RunningStats
+
+        table = 'a,b,c,label\n' + ''.join(f'{i},{2 * i + 1},5,{i % 2}\n' for i in range(8))
+        with local_dataset({'table.csv': table}):
+            data_loader = DataLoader(dataset_name='table.csv', batch_size=4, shuffle=False, header=True)
+            statistics = data_loader.data_statistics
+            loaded = data_loader.data.features
+            data_loader.apply_transformation(normalize_features(statistics))
+            features = data_loader.materialize().data.features
+            self.assertEqual(loaded[:, 0].tolist(), list(range(8)))
+            np.testing.assert_allclose(features[:, :2].mean(axis=0), 0, atol=1e-6)
+            np.testing.assert_allclose(features[:, :2].std(axis=0), 1, rtol=1e-5)
+            self.assertEqual(features[:, 2].tolist(), [0] * 8)
+
+            data_loader.apply_transformation(select_features(['b', 'a'], data_loader.feature_names))
+            np.testing.assert_array_equal(data_loader.materialize().data.features, features[:, [1, 0]])
+
+            scaled = normalize_features(statistics, method='minmax')(DataSample([7, 15, 5], 1))
+            np.testing.assert_allclose(scaled.features, [1, 1, 0])
+            keep = select_features(statistics=statistics, min_variance=0.5)
+            self.assertEqual(keep(DataSample(np.array([1., 2., 3.]), 0)).features.tolist(), [1, 2])
+            matrix = np.arange(12, dtype=np.float32).reshape(4, 3)
+            self.assertTrue(np.shares_memory(keep.batch(matrix), matrix))
+
+        # Projections keep the stored dtype, without a float32 copy
+        with local_dataset({f'MNIST/{label}/{i}.png': make_png(10 * i + label) for label in range(2) for i in range(2)}):
+            data_loader = DataLoader(dataset_name='MNIST', batch_size=2, shuffle=False)
+            data_loader.apply_transformation(select_features(columns=[0, 3, 6]))
+            selected = data_loader.materialize().data.features
+            self.assertEqual(selected.dtype, np.uint8)
+            self.assertEqual(selected.shape, (4, 3))
+
+        images = np.random.default_rng(0).random((6, 4, 4)).astype(np.float32)
+        stats = RunningStats().update(images, np.zeros(6))
+        batch = Pipeline(normalize_features(stats), reuse_buffers=True).apply_batch(Batch(images, np.zeros(6)))
+        self.assertEqual(batch.features.shape, (6, 4, 4))
+        np.testing.assert_allclose(batch.features.mean(axis=0), 0, atol=1e-5)
+        with self.assertRaises(ValueError):
+            normalize_features(stats, method='robust')
+
+    def test_prefetch(self):
+        """Test Case 36: Background Prefetch"""
+        import time
+
+        collated = []
+
+        def collate(samples):
+            collated.append(len(samples))
+            if len(collated) == 100:
+                raise RuntimeError("bad batch")
+            return [sample.label for sample in samples]
+
+        with local_dataset({'rows.csv': make_csv(40)}):
+            serial = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False)
+            prefetched = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, prefetch=2)
+            for expected, batch in zip(serial, prefetched):
+                np.testing.assert_array_equal(batch.features, expected.features)
+            self.assertEqual(len(list(prefetched)), 10)
+
+            data_loader = DataLoader(dataset_name='rows.csv', batch_size=4, shuffle=False, prefetch=2,
+                                     collate_fn=collate)
+            with data_loader.batch_context():
+                for batch in data_loader:
+                    thread = data_loader._prefetcher._thread
+                    deadline = time.time() + 5
+                    while len(collated) < 3 and time.time() < deadline:
+                        time.sleep(0.01)
+                    time.sleep(0.1)
+                    # One consumed, two queued, one waiting for room
+                    self.assertLessEqual(len(collated), 4)
+                    break
+            self.assertIsNone(data_loader._prefetcher)
+            self.assertFalse(thread.is_alive())
+
+            collated[:] = [0] * 98
+            with self.assertRaises(RuntimeError):
+                list(data_loader)
+            self.assertFalse(data_loader._prefetcher._thread.is_alive())
+
+            streamed = DataLoader(dataset_name='rows.csv', batch_size=6, streaming=True, shuffle=False, prefetch=3)
+            self.assertEqual(sum(len(batch) for batch in streamed), 40)
+            with self.assertRaises(ValueError):
+                DataLoader(dataset_name='rows.csv', prefetch=2, reuse_buffers=True)
+
+    def test_refresh(self):
+        """Test Case 37: Incremental Refresh"""
+        def write(path, content):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+                f.write(content)
+
+        images = {f'MNIST/{label}/{i}.png': make_png(40 * i + label) for label in (0, 1) for i in range(3)}
+        with local_dataset(images):
+            reads = []
+            data_loader = DataLoader(dataset_name='MNIST', batch_size=4, shuffle=False,
+                                     preprocess_func=lambda x: reads.append(x.label) or x)
+            self.assertEqual(data_loader.data_statistics['num_samples'], 6)
+            self.assertEqual(data_loader.refresh(), {'added': [], 'changed': [], 'removed': []})
+            write('datasets/MNIST/1/new.png', make_png(250))
+            write('datasets/MNIST/2/new.png', make_png(7))
+            reads.clear()
+            result = data_loader.refresh()
+            self.assertEqual(sorted(result['added']), ['datasets/MNIST/1/new.png', 'datasets/MNIST/2/new.png'])
+            self.assertEqual(sorted(reads), [1, 2])
+            fresh = DataLoader(dataset_name='MNIST', batch_size=4, shuffle=False)
+            self.assertEqual(data_loader.data_statistics['label_counts'], fresh.data_statistics['label_counts'])
+            np.testing.assert_allclose(data_loader.data_statistics['feature_means'],
+                                       fresh.data_statistics['feature_means'], rtol=1e-6)
+            self.assertEqual(sum(len(batch) for batch in data_loader), 8)
+
+        with local_dataset({'notes/a/1.txt': 'one', 'notes/a/2.txt': 'two', 'notes/b/3.txt': 'three'}):
+            data_loader = DataLoader(dataset_name='notes', batch_size=2, shuffle=False)
+            data_loader.filter_data(lambda x: x.features != 'skip')
+            self.assertEqual(len(list(data_loader)), 2)
+            write('datasets/notes/a/2.txt', 'TWO!')
+            write('datasets/notes/b/4.txt', 'skip')
+            os.remove('datasets/notes/b/3.txt')
+            result = data_loader.refresh()
+            self.assertEqual(result['changed'], ['datasets/notes/a/2.txt'])
+            self.assertEqual(result['removed'], ['datasets/notes/b/3.txt'])
+            self.assertEqual(sorted(sample.features for sample in data_loader.data), ['TWO!', 'one'])
+
+        with local_dataset({'rows.csv': make_csv(4)}):
+            data_loader = DataLoader(dataset_name='rows.csv', batch_size=2, shuffle=False)
+            data_loader.apply_transformation(lambda x: x._replace(features=x.features + 1))
+            data_loader.materialize()
+            self.assertEqual(data_loader.refresh()['changed'], [])
+            write('datasets/rows.csv', make_csv(6))
+            self.assertEqual(data_loader.refresh()['changed'], ['datasets/rows.csv'])
+            self.assertEqual(data_loader.materialize().data.features[:, 0].tolist(), [1, 2, 3, 4, 5, 6])
+
+    def test_epoch_augmentation(self):
+        """Test Case 38: Per-Epoch Seeded Augmentation"""
+        from dataloader.preprocessors import augment, normalize
+
+        rng = np.random.default_rng(1)
+        images = {f'MNIST/{label}/{i}.png': make_png(int(v)) for label in (0, 1)
+                  for i, v in enumerate(rng.integers(0, 255, 4))}
+        images['MNIST/0/edge.png'] = make_png(255, size=(8, 8))
+        with local_dataset(images):
+            calls = []
+            options = dict(dataset_name='MNIST', batch_size=3, shuffle=False, seed=7, augment_func=augment,
+                           preprocess_func=lambda x: calls.append(1) or normalize(x))
+            data_loader = DataLoader(**options)
+            self.assertEqual(len(calls), 9)
+            first, second = [np.concatenate([b.features for b in data_loader]) for _ in range(2)]
+            self.assertEqual(len(calls), 9)
+            self.assertFalse(np.array_equal(first, second))
+            self.assertFalse(np.array_equal(first, data_loader.data.features))
+
+            again = DataLoader(**options)
+            np.testing.assert_array_equal(np.concatenate([b.features for b in again]), first)
+            prefetched = DataLoader(prefetch=2, **options)
+            np.testing.assert_array_equal(np.concatenate([b.features for b in prefetched]), first)
+            data_loader.set_epoch(0)
+            np.testing.assert_array_equal(np.concatenate([b.features for b in data_loader]), first)
+
+        text = DataSample(features='hello', label=0)
+        self.assertEqual(augment(text, rng=np.random.default_rng(3)), augment(text, rng=np.random.default_rng(3)))
+
+    def test_bucketed_batches(self):
+        """Test Case 39: Length-Bucketed Batching"""
+        from dataloader.preprocessors import tokenize
+        from dataloader.samplers import BucketBatchSampler
+
+        rng = np.random.default_rng(0)
+        lengths = rng.integers(1, 30, size=200)
+        sampler = BucketBatchSampler(max_tokens=64, seed=1)
+        batches = sampler.batches(lengths, epoch=0)
+        self.assertEqual(sorted(np.concatenate(batches).tolist()), list(range(200)))
+        self.assertTrue(all(lengths[b].max() * len(b) <= 64 for b in batches))
+        padded = sum(lengths[b].max() * len(b) for b in batches)
+        self.assertLess(padded, 1.25 * lengths.sum())
+        self.assertNotEqual([b.tolist() for b in batches], [b.tolist() for b in sampler.batches(lengths, epoch=1)])
+        capped = BucketBatchSampler(max_tokens=1000, max_batch_size=8, pool_size=50, shuffle=False)
+        self.assertEqual(max(len(b) for b in capped.batches(lengths)), 8)
+        self.assertEqual(len(BucketBatchSampler(max_tokens=5).batches([9, 2])), 2)
+
+        files = {f'docs/{label}/{i}.txt': ' '.join(['word'] * int(n)) for label in 'ab'
+                 for i, n in enumerate(rng.integers(1, 20, size=15))}
+        with local_dataset(files):
+            data_loader = DataLoader(dataset_name='docs', tokenizer=True, max_tokens=40, seed=3)
+            lengths_before = data_loader.sample_lengths
+            epoch = list(data_loader)
+            self.assertEqual(sum(len(batch) for batch in epoch), 30)
+            self.assertTrue(all(batch.features.size <= 40 for batch in epoch if len(batch) > 1))
+            self.assertIs(data_loader.sample_lengths, lengths_before)
+            self.assertEqual(sorted(np.concatenate([batch.lengths for batch in epoch]).tolist()),
+                             sorted(lengths_before.tolist()))
+
+            words = DataLoader(dataset_name='docs', preprocess_func=tokenize, collate_fn=None, max_tokens=40)
+            self.assertTrue(all(max(len(s.features) for s in batch) * len(batch) <= 40
+                                for batch in words if len(batch) > 1))
+            with self.assertRaises(ValueError):
+                DataLoader(dataset_name='docs', streaming=True, max_tokens=40)
+
+    def test_gather_with_replacement(self):
+        """Test Case 40: Gathering Repeated Indices"""
+        from dataloader.samplers import WeightedRandomSampler
+
+        with local_dataset({'rows.csv': make_csv(10)}):
+            data_loader = DataLoader(dataset_name='rows.csv', batch_size=3, shuffle=False)
+            self.assertEqual(data_loader.gather(np.array([5, 3, 3])).labels.tolist(), [1, 1, 1])
+            np.testing.assert_array_equal(data_loader.gather(np.array([5, 3, 3])).features[:, 0], [5, 3, 3])
+            np.testing.assert_array_equal(data_loader.gather(np.array([4, 2, 3])).features[:, 0], [4, 2, 3])
+
+            weights = np.zeros(10)
+            weights[[2, 7]] = 1
+            sampled = DataLoader(dataset_name='rows.csv', batch_size=4, seed=0,
+                                 sampler=WeightedRandomSampler(weights, num_samples=12, seed=0))
+            rows = np.concatenate([batch.features[:, 0] for batch in sampled])
+            self.assertEqual(len(rows), 12)
+            self.assertTrue(set(rows.tolist()) <= {2.0, 7.0})
+
+    def test_mixed_shape_batches(self):
+        """Test Case 41: Batches of Mixed-Shape Samples"""
+        from dataloader.collate import Collator
+
+        with local_dataset({'MNIST/0/small.png': make_png(10, size=(4, 4)), 'MNIST/1/big.png': make_png(20)}):
+            batch = next(iter(DataLoader(dataset_name='MNIST', batch_size=2, shuffle=False)))
+            self.assertIsInstance(batch, list)
+            self.assertEqual(sorted(sample.features.shape for sample in batch), [(4, 4, 3), (8, 8, 3)])
+        samples = [DataSample(np.zeros((2, 2)), 0), DataSample(np.zeros(3), 1)]
+        self.assertIs(Collator(reuse_buffers=True)(samples), samples)
+
+    def test_refresh_with_file_index(self):
+        """Test Case 42: Refresh of Files Rewritten In Place"""
+        with local_dataset({'notes/a/1.txt': 'one', 'notes/a/2.txt': 'two', 'notes/b/3.txt': 'three'}):
+            data_loader = DataLoader(dataset_name='notes', batch_size=2, shuffle=False, file_index=True)
+            directory_mtime = os.stat('datasets/notes/a').st_mtime_ns
+            with open('datasets/notes/a/2.txt', 'w') as f:
+                f.write('two, rewritten')
+            self.assertEqual(os.stat('datasets/notes/a').st_mtime_ns, directory_mtime)
+            self.assertEqual(data_loader.refresh()['changed'], ['datasets/notes/a/2.txt'])
+            self.assertEqual(sorted(sample.features for sample in data_loader.data), ['one', 'three', 'two, rewritten'])
+            self.assertEqual(data_loader.refresh(), {'added': [], 'changed': [], 'removed': []})
+
+    def test_fingerprint_captured_state(self):
+        """Test Case 43: Fingerprints of Captured State"""
+        import threading
+        from dataloader.utils import function_fingerprint
+
+        weights = np.ones(3, dtype=np.float32)
+        scale = lambda x: x._replace(features=x.features * weights)
+        before = function_fingerprint(scale)
+        weights[0] = 2
+        self.assertNotEqual(function_fingerprint(scale), before)
+
+        class Shift:
+            def __init__(self, offset):
+                self.offset = offset
+
+            def apply(self, sample):
+                return sample._replace(features=sample.features + self.offset)
+        self.assertNotEqual(function_fingerprint(Shift(1).apply), function_fingerprint(Shift(2).apply))
+        self.assertEqual(function_fingerprint(Shift(1).apply), function_fingerprint(Shift(1).apply))
+
+        with local_dataset({'rows.csv': make_csv(4)}):
+            shift = Shift(1)
+            data_loader = DataLoader(dataset_name='rows.csv', shuffle=False, cache=True)
+            data_loader.apply_transformation(shift.apply)
+            self.assertEqual(data_loader.materialize().data.features[:, 0].tolist(), [1, 2, 3, 4])
+            shift.offset = 10
+            changed = DataLoader(dataset_name='rows.csv', shuffle=False, cache=True)
+            changed.apply_transformation(shift.apply)
+            self.assertEqual(changed.materialize().data.features[:, 0].tolist(), [10, 11, 12, 13])
+
+            lock = threading.Lock()
+            locked = DataLoader(dataset_name='rows.csv', shuffle=False, cache=True)
+            locked.apply_transformation(lambda x: lock and x)
+            with self.assertRaises(TypeError):
+                locked.plan_key()
+            self.assertEqual(len(locked.materialize().data), 4)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file